@@ -1,12 +1,57 @@
+import array
+import collections
+import concurrent.futures
+import contextlib
+import gc
+import gzip
+import heapq
+import io
+import itertools
+import json
+import lzma
 import os
+import re
+import threading
+import time
 
-from PyQt5.QtWidgets import QProgressBar, QLabel
+from PyQt5.QtWidgets import QApplication, QProgressBar, QLabel
 
+import query as q
+import scanner
 import util
 
 CACHE_DIR = "_cache"
 SUPPORTED_IMAGE_FORMATS = {"bmp", "png", "jpg", "jpeg", "gif", "cur", "ico", "jfif", "pbm", "pgm", "ppm", "svg", "svgz", "xbm", "xpm"}
 SUPPORTED_VIDEO_FORMATS = {"mp4", "mov", "avi", "flv", "mkv"}
+QUERY_CACHE_SIZE = 128
+QUERY_CACHE_IDS = 1 << 21
+PHRASE_CACHE_SIZE = 64
+PHRASE_CACHE_ENTRIES = 1 << 16
+PHRASE_CACHE_MATCHES = 1 << 12
+FUZZY_WEIGHT = 0.5
+FUZZY_MIN_LENGTH = 4
+TEXT_INDEX_REBUILD = 4
+TEXT_INDEX_CHUNK = 64
+FACET_INTERSECT_COST = 64
+SQLITE_SUFFIX = ".sqlite"
+LOAD_WORKERS = os.cpu_count() or 1
+LOAD_QUEUE_DEPTH = 4
+LOAD_BATCH_SIZE = 64
+LOAD_PROGRESS_INTERVAL = 1024
+SNAPSHOT_VERSION = 4
+SNAPSHOT_FORMAT = b"APPL snapshot " + str(SNAPSHOT_VERSION).encode()
+SNAPSHOT_SUFFIX = ".idx"
+SNAPSHOT_COLUMNS = ("path", "cover_path", "name", "author", "series", "language", "age_rating", "tags",
+                    "name_key", "path_key")
+SNAPSHOT_RANGES = ("releases", "vols", "resolutions")
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_OLD_SUFFIX = ".old"
+JOURNAL_HEADER = "journal"
+JOURNAL_SYNC_COUNT = 1024
+JOURNAL_COMPACT_SIZE = 1 << 20
+JOURNAL_ENTRY_CHANGES = {"set_cover", "set_name", "set_author", "set_series", "set_vol", "set_language",
+                         "set_rating", "set_release", "set_resolution", "add_tag", "remove_tag", "set_tags",
+                         "move_entry"}
 
 #
 #
@@ -22,7 +67,14 @@ SUPPORTED_VIDEO_FORMATS = {"mp4", "mov", "avi", "flv", "mkv"}
 # Resolution
 # Isekai, Fantasy, Sci-Fi, Male-lead
 #
+# Values repeated across entries (authors, languages, resolutions, tags...)
+# are interned by the database holding the entry, so each entry holds a
+# reference rather than its own copy
+#
 class Entry:
+    __slots__ = ("path", "cover_path", "name", "author", "series", "vol", "language", "age_rating",
+                 "release", "resolution", "tags", "id", "name_key", "path_key")
+
     def __init__(self,
                  path,
                  cover_path,
@@ -34,7 +86,8 @@ class Entry:
                  age_rating,
                  release,
                  resolution,
-                 tags):
+                 tags,
+                 keys=None):
         self.path = path
         self.cover_path = cover_path
         self.name = name
@@ -44,8 +97,21 @@ class Entry:
         self.language = language
         self.age_rating = age_rating
         self.release = release
-        self.resolution = resolution
+        self.resolution = tuple(resolution)
         self.tags = tags
+        self.id = -1
+        if keys is None:
+            self.update_keys()
+        else:
+            self.name_key, self.path_key = keys
+
+    # Normalized name and path, so searches don't normalize every entry
+    def update_keys(self):
+        self.name_key = util.normalize(self.name)
+        self.path_key = util.normalize(self.path)
+
+    def pixels(self) -> int:
+        return self.resolution[0] * self.resolution[1]
 
     def __str__(self):
         return ('path: ' + self.path +
@@ -62,6 +128,495 @@ class Entry:
                 )
 
 
+# Every trigram of the normalized name and path of an entry
+def entry_trigrams(entry: Entry) -> set:
+    return util.trigrams(entry.name_key) | util.trigrams(entry.path_key)
+
+
+# Every token found in the searchable fields of an entry -> whether it's
+# found outside of its path
+def entry_tokens(entry: Entry) -> dict:
+    tokens = dict.fromkeys(util.split_tokens(entry.path_key), False)
+    for token in util.split_tokens(entry.name_key):
+        tokens[token] = True
+    for field in (entry.author, entry.series, entry.language, entry.age_rating, *entry.tags):
+        for token in util.tokenize(field):
+            tokens[token] = True
+    return tokens
+
+
+# Typos in numbers or very short words aren't worth correcting
+def fuzzy_token(token: str) -> bool:
+    return len(token) >= 3 and not token.isdigit()
+
+
+def entry_extensions(entry: Entry) -> tuple:
+    if "." not in entry.path:
+        return ()
+    return (util.normalize(entry.path[entry.path.rfind(".")+1:]),)
+
+
+#
+# Secondary Indexes
+#
+# Every index is declared once, by the Database attribute holding it,
+# the entry fields it's built from and the keys it files an entry under.
+# Adding, changing and removing entries all go through the same
+# Database.index_entry / unindex_entry, which only touch the indexes
+# built from the fields that changed.
+#
+class Index:
+    def __init__(self, attribute: str, fields: tuple, keys):
+        self.attribute = attribute
+        self.fields = frozenset(fields)
+        self.keys = keys
+
+    def remove_many(self, database, entries: list):
+        for entry in entries:
+            self.remove(database, entry)
+
+
+# Normalized value -> Bitmap of ids. How many entries hold each value,
+# and how it was first written, are kept alongside for the filter dialog.
+class FacetIndex(Index):
+    def __init__(self, attribute: str, fields: tuple, values):
+        super().__init__(attribute, fields, lambda e: {util.normalize(v): v for v in values(e)})
+
+    def add(self, database, entry: Entry):
+        counts = database.value_counts[self.attribute]
+        labels = database.value_labels[self.attribute]
+        for key, label in self.keys(entry).items():
+            util.dictionary_bitmap_add(getattr(database, self.attribute), key, entry.id)
+            counts[key] = counts.get(key, 0) + 1
+            if key not in labels:
+                labels[key] = label
+
+    def remove(self, database, entry: Entry):
+        counts = database.value_counts[self.attribute]
+        labels = database.value_labels[self.attribute]
+        for key in self.keys(entry):
+            util.dictionary_bitmap_remove(getattr(database, self.attribute), key, entry.id)
+            counts[key] = counts.get(key, 0) - 1
+            if counts[key] <= 0:
+                counts.pop(key)
+                labels.pop(key, None)
+
+
+# util.SortedIndex of (value, id)
+class RangeIndex(Index):
+    def add(self, database, entry: Entry):
+        for key in self.keys(entry):
+            getattr(database, self.attribute).add(key, entry.id)
+
+    def remove(self, database, entry: Entry):
+        for key in self.keys(entry):
+            getattr(database, self.attribute).remove(key, entry.id)
+
+    def remove_many(self, database, entries: list):
+        getattr(database, self.attribute).remove_many((k, e.id) for e in entries for k in self.keys(e))
+
+
+# Relative path -> Entry
+class PathIndex(Index):
+    def add(self, database, entry: Entry):
+        for key in self.keys(entry):
+            getattr(database, self.attribute)[key] = entry
+
+    def remove(self, database, entry: Entry):
+        for key in self.keys(entry):
+            getattr(database, self.attribute).pop(key, None)
+
+
+# util.Trie of the folders in relative paths, counting entries by extension.
+# Only kept once it's first used.
+class DirectoryIndex(Index):
+    def add(self, database, entry: Entry):
+        if not database.directories_built:
+            return
+        extension = "".join(entry_extensions(entry))
+        for key in self.keys(entry):
+            getattr(database, self.attribute).add(key, "/", entry, extension)
+
+    def remove(self, database, entry: Entry):
+        if not database.directories_built:
+            return
+        for key in self.keys(entry):
+            getattr(database, self.attribute).remove(key, "/")
+
+
+# Key -> ordered set of entries, only kept for the entries the text index
+# has been built over. New keys are added to the fuzzy index, except those
+# only found in paths, mostly file names, which wait for a second entry to
+# hold them. Keys leave with their last entry.
+class TextIndex(Index):
+    def __init__(self, attribute: str, fields: tuple, keys, fuzzy: bool):
+        super().__init__(attribute, fields, keys)
+        self.fuzzy = fuzzy
+
+    def add(self, database, entry: Entry):
+        if database.text_indexed or entry.id < database.text_cursor:
+            self.insert(database, entry)
+
+    def insert(self, database, entry: Entry):
+        postings = getattr(database, self.attribute)
+        keys = self.keys(entry)
+        for key in keys:
+            if key in postings:
+                postings[key][entry] = None
+            else:
+                postings[key] = {entry: None}
+        if not self.fuzzy:
+            return
+        for key, outside_path in keys.items():
+            held = len(postings[key])
+            if held > 2 or not fuzzy_token(key):
+                continue
+            if held == 1 and outside_path:
+                database.fuzzy.add(key)
+            elif held == 2 and not self.keys(next(iter(postings[key])))[key]:
+                database.fuzzy.add(key)
+
+    def remove(self, database, entry: Entry):
+        if not database.text_indexed and entry.id >= database.text_cursor:
+            return
+        postings = getattr(database, self.attribute)
+        for key in self.keys(entry):
+            util.dictionary_set_remove(postings, key, entry)
+            if self.fuzzy and key not in postings and fuzzy_token(key):
+                database.fuzzy.remove(key)
+
+
+TEXT_FIELDS = ("name", "path", "author", "series", "language", "age_rating", "tags")
+INDEXES = (
+    FacetIndex("authors", ("author",), lambda e: (e.author,)),
+    FacetIndex("series", ("series",), lambda e: (e.series,)),
+    FacetIndex("languages", ("language",), lambda e: (e.language,)),
+    FacetIndex("age_ratings", ("age_rating",), lambda e: (e.age_rating,)),
+    FacetIndex("tags", ("tags",), lambda e: e.tags),
+    FacetIndex("extensions", ("path",), entry_extensions),
+    PathIndex("filepaths", ("path",), lambda e: (e.path,)),
+    DirectoryIndex("directories", ("path",), lambda e: (e.path,)),
+    RangeIndex("releases", ("release",), lambda e: (e.release,)),
+    RangeIndex("vols", ("vol",), lambda e: (e.vol,)),
+    RangeIndex("resolutions", ("resolution",), lambda e: (e.pixels(),)),
+    TextIndex("tokens", TEXT_FIELDS, entry_tokens, fuzzy=True),
+    TextIndex("trigrams", ("name", "path"), entry_trigrams, fuzzy=False),
+)
+FACETS = tuple(i.attribute for i in INDEXES if isinstance(i, FacetIndex))
+
+
+#
+# APPL Parsing
+#
+# Files are read a line at a time. A record is the nine lines after a
+# "---" line and its blank line, so a name holding "---" can't split it.
+#
+RECORD_SEPARATOR = "---"
+RECORD_LINES = 9
+
+
+# Yields the header lines, then the lines of every record
+def read_appl(file):
+    header = []
+    line = file.readline()
+    while line != "" and line.rstrip("\n") != RECORD_SEPARATOR:
+        header.append(line.rstrip("\n"))
+        line = file.readline()
+    yield header
+
+    while line != "":
+        file.readline()
+        yield [file.readline().rstrip("\n") for _ in range(RECORD_LINES)]
+        line = file.readline()
+        while line != "" and line.rstrip("\n") != RECORD_SEPARATOR:
+            line = file.readline()
+
+
+def parse_header(header: list) -> tuple:
+    name = header[0]  # Collection Name
+    db_dir = header[1]  # Collection Directory
+
+    # App Associations
+    app_associations = {a.split(":")[0].strip(): a.split(":")[1].strip() for a in (header[3]
+                        .replace("{", "").replace("}", "")
+                        .replace("\"", "").replace("'", "").split(","))}
+    return name, db_dir, app_associations, int(header[4].strip())
+
+
+# The ids of the journals whose changes the file already holds, listed
+# after the entry count when it was written over them
+def parse_journals(header: list) -> list:
+    if len(header) > 5 and header[5].startswith(JOURNAL_HEADER + " "):
+        return header[5].split()[1:]
+    return []
+
+
+def parse_entry(lines: list) -> Entry:
+    series, _, vol = lines[4].rpartition(",")
+    language, _, age_rating = lines[5].partition(",")
+    width, _, height = lines[7].partition("x")
+    return Entry(
+        path=lines[0],
+        cover_path=lines[1],
+        name=lines[2],
+        author=lines[3],
+        series=series.strip(),
+        vol=int(vol.strip()),
+        language=language.strip(),
+        age_rating=age_rating.strip(),
+        release=int(lines[6].strip()),
+        resolution=(int(width), int(height)),
+        tags=[t.strip() for t in lines[8].split(",")]
+    )
+
+
+def format_entry(entry: Entry) -> str:
+    return (
+        "\n---\n\n"
+        + entry.path + "\n"
+        + entry.cover_path + "\n"
+        + entry.name + "\n"
+        + entry.author + "\n"
+        + entry.series + ", " + str(entry.vol) + "\n"
+        + entry.language + ", " + entry.age_rating + "\n"
+        + str(entry.release) + "\n"
+        + str(entry.resolution[0]) + "x" + str(entry.resolution[1]) + "\n"
+        + str(entry.tags)[1:-1].replace("'", "") + "\n"
+    )
+
+
+# APPL files ending in .gz or .xz are compressed
+def open_compressed(fileobj, filepath: str, mode: str):
+    if filepath.endswith(".gz"):
+        return gzip.GzipFile(fileobj=fileobj, mode=mode)
+    if filepath.endswith(".xz"):
+        return lzma.LZMAFile(fileobj, mode=mode)
+    return fileobj
+
+
+# Streams the records into a temp file, which only replaces the file
+# once it's completely on disk
+def write_appl(filepath: str, records):
+    temp_path = filepath + ".tmp"
+    with open(temp_path, "wb") as raw:
+        stream = open_compressed(raw, filepath, "wb")
+        file = io.TextIOWrapper(stream, encoding="utf-8")
+        file.writelines(records)
+        file.flush()
+        file.detach()
+        if stream is not raw:
+            stream.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(temp_path, filepath)
+
+
+# Written by a background thread, so saving never waits on a compaction.
+# The file names the journal it folds in, so should the journal outlive
+# it, it isn't replayed over it again.
+def write_compacted(filepath: str, records: list, journal_path: str):
+    write_appl(filepath, records)
+    os.remove(journal_path)
+
+
+# Journals start with a line naming them, so files can record which
+# journals they hold. Those from before have no id.
+def read_journal_id(path: str):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            change = json.loads(file.readline())
+    except (OSError, ValueError):
+        return None
+    if isinstance(change, list) and len(change) == 2 and change[0] == JOURNAL_HEADER:
+        return change[1]
+    return None
+
+
+# Loading makes millions of objects and no garbage, so the cyclic
+# collector waits until it's done rather than walking them over and over
+@contextlib.contextmanager
+def collector_paused():
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if collecting:
+            gc.enable()
+
+
+# Snapshot sections
+# Tags are joined as in the APPL file, which can't hold commas in them either
+def snapshot_column(entries, field: str) -> list:
+    if field == "tags":
+        return [",".join(e.tags) for e in entries]
+    return [getattr(e, field) for e in entries]
+
+
+def json_bytes(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def int_column(data: bytes) -> list:
+    column = array.array("q")
+    column.frombytes(data)
+    return column.tolist()
+
+
+#
+# Import Pipeline
+#
+# Files are walked, then classified into the entries they'd become, in
+# walk order, so the first file of a folder of numbered frames claims it.
+# Reading metadata and caching covers is spread over worker processes,
+# and the results come back in walk order to be added a batch at a time,
+# leaving the same entries as handling each file in turn.
+#
+
+# The database file relative to the collection directory, or None when
+# it's kept elsewhere
+def database_file(db_dir: str, filepath: str):
+    base = os.path.abspath(db_dir).replace("\\", "/").rstrip("/") + "/"
+    filepath = os.path.abspath(filepath).replace("\\", "/")
+    return filepath[len(base):] if filepath.startswith(base) else None
+
+
+# Covers cached by the database and AppleDouble files. Also true of the
+# directories holding them, given with a trailing "/". When the database
+# is kept in the collection, its file and everything kept beside it (the
+# snapshot, journals, scan manifest, temporary files and SQLite's own) are
+# skipped too.
+def ignored_file(db_dir: str, file: str, database: str = None) -> bool:
+    file = file.replace("\\", "/")
+    if database is not None:
+        relative = file[len(scanner.base_dir(db_dir)):]
+        if relative.startswith(database) and relative[len(database):len(database) + 1] in ("", ".", "-"):
+            return True
+    return file[len(db_dir):][:len(CACHE_DIR)] == CACHE_DIR or "._" in file
+
+
+# (file, name, extension, cover) of the entry a file becomes, or None
+# for files that never become entries
+def classify_file(db_dir: str, file: str):
+    if ignored_file(db_dir, file):
+        return None
+    file = file.replace("\\", "/")
+
+    entry_name = file[file.rfind("/")+1:file.rfind(".")]
+    entry_ext = file[file.rfind(".")+1:].lower()
+    entry_cover = "unknown"
+    if entry_ext in SUPPORTED_IMAGE_FORMATS:
+        entry_cover = file
+    if entry_name.strip().replace("_", "").replace(".", "").isdigit():
+        file = file[:file.rfind("/")]
+        entry_name = file[file.rfind("/") + 1:]
+    return file, entry_name, entry_ext, entry_cover
+
+
+# Runs in a worker process, returning the fields of the new entry
+def extract_file(task: tuple) -> tuple:
+    db_dir, file, entry_name, entry_ext, entry_cover = task
+    entry_lang = "unknown"
+    entry_author = "unknown"
+    entry_res = (0, 0)
+    if entry_ext in SUPPORTED_VIDEO_FORMATS:
+        entry_cover = util.cache_video_cover(db_dir, CACHE_DIR, file)
+        entry_res = util.get_video_resolution(file)
+    elif entry_ext == "epub":
+        entry_cover = util.cache_epub_cover(db_dir, CACHE_DIR, file)
+        entry_name, entry_author, entry_lang = util.get_epub_metadata(file)
+    elif entry_ext in SUPPORTED_IMAGE_FORMATS:
+        entry_res = util.get_image_resolution(file)
+    return file[len(db_dir):], entry_cover, entry_name, entry_author, entry_lang, entry_res
+
+
+# Results in the order of the tasks, with only a few tasks per worker
+# submitted ahead of the one being waited on
+def ordered_map(function, tasks, workers: int):
+    if workers <= 1:
+        yield from map(function, tasks)
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(executor.submit(function, task))
+            if len(pending) >= workers * LOAD_QUEUE_DEPTH:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+# Databases ending in .sqlite are kept in SQLite rather than in memory
+def open_database(filepath: str):
+    if filepath.endswith(SQLITE_SUFFIX):
+        import sqlite_database
+        return sqlite_database.SQLiteDatabase(filepath)
+    return Database(filepath)
+
+
+# Entry Registry
+# Live entries by id, in the order they were added. Used like the list it
+# replaces, except removing an entry doesn't scan for it.
+class EntryRegistry:
+    def __init__(self):
+        self.by_id = dict()
+
+    def append(self, entry: Entry):
+        self.by_id[entry.id] = entry
+
+    def remove(self, entry: Entry):
+        self.by_id.pop(entry.id, None)
+
+    def __contains__(self, entry: Entry) -> bool:
+        return self.by_id.get(entry.id) is entry
+
+    def __len__(self):
+        return len(self.by_id)
+
+    # Iterates a copy, so entries can be removed meanwhile
+    def __iter__(self):
+        return iter(list(self.by_id.values()))
+
+    def __getitem__(self, i: int) -> Entry:
+        if i < 0:
+            i += len(self.by_id)
+        if i < 0 or i >= len(self.by_id):
+            raise IndexError(i)
+        return next(itertools.islice(self.by_id.values(), i, None))
+
+
+# Ranked Results
+# Entries are only produced as they are fetched, so a page of a broad
+# query doesn't cost a sort of every match
+class ResultCursor:
+    def __init__(self, entries, total: int):
+        self.entries = iter(entries)
+        self.total = total
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Entry:
+        return next(self.entries)
+
+    def fetch(self, count: int) -> list:
+        return list(itertools.islice(self.entries, count))
+
+
+# Cached rankings are kept as two arrays in heap order rather than a list
+# of tuples, which takes several times the memory. Zipped back together
+# they're still a heap.
+def pack_ranked(ranked: list) -> tuple:
+    return array.array("d", (s for s, _ in ranked)), array.array("q", (i for _, i in ranked))
+
+
+def unpack_ranked(packed: tuple) -> list:
+    return list(zip(*packed))
+
+
 #
 #
 # Database Class
@@ -90,23 +645,7 @@ class Entry:
 class Database:
     # Initializes the DB
     def __init__(self, directory):
-        content = ""
-        with open(directory, "r", encoding="utf-8") as file:
-            content = file.read()
-
-        content = content.split("---")
-        header = content[0].split("\n")
-        entries = content[1:]
-
         self.file_dir = directory
-        self.name = header[0]  # Collection Name
-        self.db_dir = header[1]  # Collection Directory
-
-        # App Associations
-        self.app_associations = {a.split(":")[0].strip(): a.split(":")[1].strip() for a in (header[3]
-                                .replace("{", "").replace("}", "")
-                                .replace("\"", "").replace("'", "").split(","))}
-        self.entry_count = int(header[4].strip())
 
         # Dictionary Setups
         self.tags = dict()
@@ -117,309 +656,1073 @@ class Database:
         self.filepaths = dict()
         self.extensions = dict()
         self.directories = util.Trie()
+        self.directories_built = False
+        self.value_counts = {name: dict() for name in FACETS}
+        self.value_labels = {name: dict() for name in FACETS}
+        self.tokens = dict()
+        self.trigrams = dict()
+        self.fuzzy = util.FuzzyIndex()
+        self.fuzzy_search = True
+        self.text_indexed = False
+        self.text_cursor = 0  # Entries with lower ids are in the text indexes
+        self.journaling = False
+        self.journals = []  # Journals already folded into the file
+        self.interned = dict()  # Values repeated across entries -> the object they share
 
         self.loading_total = 0
         self.loading_current = 0
 
+        # Every mutation bumps the generation, invalidating cached queries
+        self.generation = 0
+        self.query_cache = util.LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_IDS)
+        self.phrase_cache = util.LRUCache(PHRASE_CACHE_SIZE, PHRASE_CACHE_ENTRIES)
+
         # Items
-        self.entries: [Entry] = []
-        for e in entries:
-            lines = e.split("\n")[1:]
-
-            # print(lines)
-            entry = Entry(
-                path=lines[1],
-                cover_path=lines[2],
-                name=lines[3],
-                author=lines[4],
-                series=lines[5].split(",")[0].strip(),
-                vol=int(lines[5].split(",")[1].strip()),
-                language=lines[6].split(",")[0].strip(),
-                age_rating=lines[6].split(",")[1].strip(),
-                release=int(lines[7].strip()),
-                resolution=(int(lines[8].split("x")[0]), int(lines[8].split("x")[1])),
-                tags=[t.strip() for t in lines[9].split(",")]
-            )
-            # print(str(entry))
+        self.entries = EntryRegistry()
+        self.entries_by_id: [Entry] = []
+
+        with collector_paused():
+            if not self.load_snapshot(directory):
+                self.read_file(directory)
+                self.save_snapshot(directory)
+
+            path_indexes = [i for i in INDEXES if isinstance(i, PathIndex)]
+            for entry in self.entries:
+                for index in path_indexes:
+                    index.add(self, entry)
+            self.ids = util.Bitmap(range(len(self.entries_by_id)))
+
+        # Edit Journal
+        # Changes since the file was last written are replayed on top of it
+        self.journal = None
+        self.journal_path = directory + JOURNAL_SUFFIX
+        self.journal_pending = 0
+        self.journal_size = 0
+        self.compaction = None
+        old_journal = self.journal_path + JOURNAL_OLD_SUFFIX
+        for path in (old_journal, self.journal_path):
+            if os.path.exists(path):
+                self.replay_journal(path)
+        self.journaling = True
+        # Journals without an id are folded in at once, as files can't name them
+        unnamed = os.path.exists(self.journal_path) and read_journal_id(self.journal_path) is None
+        if os.path.exists(old_journal) or unnamed:
+            self.save_as_file(directory)
+        elif os.path.exists(self.journal_path):
+            self.journal_size = os.path.getsize(self.journal_path)
+
+    def read_file(self, directory):
+        with open(directory, "rb") as raw, io.TextIOWrapper(open_compressed(raw, directory, "rb"), encoding="utf-8") as file:
+            records = read_appl(file)
+            header = next(records)
+
+            self.name, self.db_dir, self.app_associations, self.entry_count = parse_header(header)
+            self.journals = parse_journals(header)
+
+            # Facet ids are gathered into lists, then packed into bitmaps at once
+            facet_indexes = [i for i in INDEXES if isinstance(i, FacetIndex)]
+            facets = {i.attribute: dict() for i in facet_indexes}
+            for lines in records:
+                entry = parse_entry(lines)
+                self.intern_entry(entry)
+                entry.id = len(self.entries_by_id)
+                self.entries.append(entry)
+                self.entries_by_id.append(entry)
+                for index in facet_indexes:
+                    labels = self.value_labels[index.attribute]
+                    for key, label in index.keys(entry).items():
+                        util.dictionary_list_add(facets[index.attribute], key, entry.id)
+                        if key not in labels:
+                            labels[key] = label
+
+        for name, facet in facets.items():
+            setattr(self, name, {k: util.Bitmap(ids) for k, ids in facet.items()})
+            self.value_counts[name] = {k: len(ids) for k, ids in facet.items()}
+
+        # Range Indexes
+        for index in INDEXES:
+            if isinstance(index, RangeIndex):
+                setattr(self, index.attribute, util.SortedIndex((k, e.id) for e in self.entries for k in index.keys(e)))
+
+    # Binary Snapshot
+    # Entries by column with their facet and range indexes, saved beside
+    # the APPL file and only used while the APPL file's hash still matches.
+    # Only data is read from it: a line naming the format, a line of JSON
+    # describing the file it was taken of and the sections that follow,
+    # then the sections, JSON or int64 columns. Nothing past the
+    # description is read unless it matches.
+    def save_snapshot(self, filepath: str):
+        snapshot_path = filepath + SNAPSHOT_SUFFIX
+        try:
+            # Removed entries leave gaps in the ids, which reading the file again closes
+            if len(self.entries) != len(self.entries_by_id):
+                if os.path.exists(snapshot_path):
+                    os.remove(snapshot_path)
+                return
+
+            sections = {
+                "columns": json_bytes({f: snapshot_column(self.entries, f) for f in SNAPSHOT_COLUMNS}),
+                "vol": array.array("q", (e.vol for e in self.entries)).tobytes(),
+                "release": array.array("q", (e.release for e in self.entries)).tobytes(),
+                "width": array.array("q", (e.resolution[0] for e in self.entries)).tobytes(),
+                "height": array.array("q", (e.resolution[1] for e in self.entries)).tobytes(),
+                "facets": json_bytes({name: {k: list(ids) for k, ids in getattr(self, name).items()}
+                                      for name in FACETS}),
+                "labels": json_bytes(self.value_labels),
+            }
+            for name in SNAPSHOT_RANGES:
+                pairs = getattr(self, name).pairs
+                sections[name] = array.array("q", (v for v, _ in pairs)).tobytes()
+                sections[name + "_ids"] = array.array("q", (i for _, i in pairs)).tobytes()
+            description = {
+                "hash": util.hash_file(filepath),
+                "header": [self.name, self.db_dir, self.app_associations, self.entry_count],
+                "journals": self.journals,
+                "sections": [[name, len(data)] for name, data in sections.items()],
+            }
+            with open(snapshot_path + ".tmp", "wb") as file:
+                file.write(SNAPSHOT_FORMAT + b"\n")
+                file.write(json_bytes(description) + b"\n")
+                file.writelines(sections.values())
+            os.replace(snapshot_path + ".tmp", snapshot_path)
+        except (OSError, OverflowError) as e:
+            print("Snapshot not saved:", e)
+
+    def load_snapshot(self, filepath: str) -> bool:
+        snapshot_path = filepath + SNAPSHOT_SUFFIX
+        if not os.path.exists(snapshot_path):
+            return False
+        try:
+            with open(snapshot_path, "rb") as file:
+                if file.readline() != SNAPSHOT_FORMAT + b"\n":
+                    return False
+                description = json.loads(file.readline())
+                if description["hash"] != util.hash_file(filepath):
+                    return False
+                sections = dict()
+                for name, length in description["sections"]:
+                    sections[name] = file.read(length)
+                    if len(sections[name]) != length:
+                        raise ValueError("Snapshot cut short")
+
+            name, db_dir, app_associations, entry_count = description["header"]
+            columns = json.loads(sections["columns"])
+            columns = [columns[f] for f in SNAPSHOT_COLUMNS]
+            columns.extend(int_column(sections[f]) for f in ("vol", "release", "width", "height"))
+            if any(len(column) != len(columns[0]) for column in columns):
+                raise ValueError("Snapshot columns differ in length")
+            entries = []
+            for i, (path, cover, entry_name, author, series, language, age_rating, tags, name_key, path_key,
+                    vol, release, width, height) in enumerate(zip(*columns)):
+                # Keys were normalized when the snapshot was saved
+                entry = Entry(path, cover, entry_name, author, series, vol, language, age_rating, release,
+                              (width, height), tags.split(","), keys=(name_key, path_key))
+                entry.id = i
+                entries.append(entry)
+            facets = json.loads(sections["facets"])
+            labels = json.loads(sections["labels"])
+            ranges = [list(zip(int_column(sections[r]), int_column(sections[r + "_ids"]))) for r in SNAPSHOT_RANGES]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            print("Snapshot not loaded:", e)
+            return False
+
+        self.name, self.db_dir, self.app_associations, self.entry_count = name, db_dir, app_associations, entry_count
+        self.journals = description["journals"]
+        for entry in entries:
+            self.intern_entry(entry)
             self.entries.append(entry)
+        self.entries_by_id = list(self.entries)
 
-            util.dictionary_list_add(self.authors, entry.author.lower(), entry)
-            util.dictionary_list_add(self.series, entry.series.lower(), entry)
-            util.dictionary_list_add(self.languages, entry.language.lower(), entry)
-            util.dictionary_list_add(self.age_ratings, entry.age_rating.lower(), entry)
-            self.filepaths[entry.path] = entry
-            self.directories.add(entry.path, "/", entry)
-            for tag in entry.tags:
-                util.dictionary_list_add(self.tags, tag.lower(), entry)
-            if "." in entry.path:
-                util.dictionary_list_add(self.extensions, entry.path[entry.path.rfind(".")+1:], entry)
+        for name, facet in facets.items():
+            setattr(self, name, {k: util.bitmap_from_ids(ids) for k, ids in facet.items()})
+            self.value_counts[name] = {k: len(ids) for k, ids in facet.items()}
+        self.value_labels = labels
+        # Pairs were saved in order
+        for name, pairs in zip(SNAPSHOT_RANGES, ranges):
+            index = util.SortedIndex()
+            index.pairs = pairs
+            setattr(self, name, index)
+        return True
 
     def add_entry(self, entry):
+        self.generation += 1
+        self.intern_entry(entry)
+        entry.id = len(self.entries_by_id)
         self.entries.append(entry)
+        self.entries_by_id.append(entry)
         self.entry_count += 1
+        self.ids.add(entry.id)
+        self.index_entry(entry)
+        self.record("add_entry", entry.path, entry.cover_path, entry.name, entry.author, entry.series, entry.vol,
+                    entry.language, entry.age_rating, entry.release, *entry.resolution, entry.tags)
 
-        util.dictionary_list_add(self.authors, entry.author.lower(), entry)
-        util.dictionary_list_add(self.series, entry.series.lower(), entry)
-        util.dictionary_list_add(self.languages, entry.language.lower(), entry)
-        util.dictionary_list_add(self.age_ratings, entry.age_rating.lower(), entry)
-        self.directories.add(entry.path, "/", entry)
-        self.filepaths[entry.path] = entry
-        for tag in entry.tags:
-            util.dictionary_list_add(self.tags, tag.lower(), entry)
+    def add_entries(self, entries: list):
+        for entry in entries:
+            self.add_entry(entry)
+
+    # Whether loading and watching the collection skip a file
+    def ignored_files(self):
+        database = database_file(self.db_dir, self.file_dir)
+        return lambda file: ignored_file(self.db_dir, file, database)
 
     def clean_entries(self):
-        for e in self.entries:
-            if not os.path.exists(self.db_dir + e.path):
-                self.remove_entry(e)
-
-    def load_files(self, bar: QProgressBar, label: QLabel):
-        # print(os.listdir(self.db_dir))
-        all_files = []
-        for root, _, files in os.walk(self.db_dir):
-            for file in files:
-                all_files.append(os.path.join(root, file))
-        print(all_files)
-
-        total_files = len(all_files)
-        print(total_files)
-        current_file = 0
+        self.remove_entries([e.id for e in self.entries if not os.path.exists(self.db_dir + e.path)])
+
+    # Extracts the files of the tasks and adds their entries a batch at a
+    # time. Tasks of changed files have their existing entry in the deque,
+    # and only refresh what's read from their contents, so names, authors
+    # and tags set by hand are kept.
+    def import_files(self, tasks, existing_entries, workers: int, report: dict, progress=None):
+        batch = []
+
+        def commit():
+            added = [entry for entry, existing in batch if existing is None]
+            self.add_entries(added)
+            for entry, existing in batch:
+                if existing is None:
+                    continue
+                if existing.cover_path != entry.cover_path:
+                    self.set_cover(existing, entry.cover_path)
+                if existing.resolution != entry.resolution:
+                    self.set_resolution(existing, *entry.resolution)
+            report["added"] += len(added)
+            report["changed"] += len(batch) - len(added)
+            batch.clear()
+
+        for path, cover, name, author, language, resolution in ordered_map(extract_file, tasks, workers):
+            entry = Entry(path, cover, name, author, "unknown", 1, language, "NA", 0, resolution, ["unknown"])
+            batch.append((entry, existing_entries.popleft()))
+            if len(batch) >= LOAD_BATCH_SIZE:
+                commit()
+                if progress is not None:
+                    progress()
+        commit()
+
+    # Loads the files added since the last scan, reads the ones that changed
+    # again and removes the entries of the ones that are gone. Entries whose
+    # files were moved or renamed are found by fingerprint and moved along,
+    # keeping everything set by hand. Returns how many entries were added,
+    # changed and moved, and the paths of those removed.
+    def load_files(self, bar: QProgressBar, label: QLabel, workers: int = LOAD_WORKERS) -> dict:
+        manifest_path = self.file_dir + scanner.MANIFEST_SUFFIX
+        old_manifest = scanner.load_manifest(manifest_path, self.db_dir)
+        manifest = scanner.ScanManifest(self.db_dir)
+        base = scanner.base_dir(self.db_dir)
+        walk = scanner.scan(old_manifest, manifest, self.ignored_files())
+
+        # The number of files is only known once the walk is done, so the
+        # bar stays busy and the label counts the files walked so far
+        walked = 0
+
+        def progress():
+            if bar is not None:
+                label.setText(str(walked) + " files")
+                QApplication.processEvents()
+
+        if bar is not None:
+            bar.setMaximum(0)
+            bar.setValue(0)
+            label.setText("0 files")
+
+        report = {"added": 0, "changed": 0, "moved": 0, "removed": []}
+
+        # Existing entry (if the file changed) of every task
+        existing_entries = collections.deque()
+        claimed = dict()  # Entry path -> first file making it up
+
+        # Unchanged files keep the fingerprint they had
+        def file_fingerprint(file: str, unchanged: bool):
+            if unchanged and file in old_manifest.fingerprints:
+                fingerprint = old_manifest.fingerprints[file]
+            else:
+                fingerprint = scanner.fingerprint(base + file)
+            manifest.fingerprints[file] = fingerprint
+            return fingerprint
+
+        def tasks():
+            nonlocal walked
+            for file in walk:
+                walked += 1
+                if walked % LOAD_PROGRESS_INTERVAL == 0:
+                    progress()
+                item = classify_file(self.db_dir, base + file)
+                if item is None:
+                    continue
+                path = item[0][len(self.db_dir):]
+                if path in claimed:
+                    print("skip file")
+                    continue
+                claimed[path] = file
+                if path in self.filepaths:
+                    unchanged = old_manifest.files.get(file, manifest.files[file]) == manifest.files[file]
+                    file_fingerprint(file, unchanged)
+                    if unchanged:
+                        print("skip file")
+                        continue
+                    existing_entries.append(self.filepaths[path])
+                else:
+                    moved = self.moved_entry(old_manifest, file_fingerprint(file, False), claimed)
+                    if moved is not None:
+                        self.move_entry(moved, path)
+                        report["moved"] += 1
+                        continue
+                    existing_entries.append(None)
+                yield (self.db_dir, *item)
+
+        self.import_files(tasks(), existing_entries, workers, report, progress)
+
+        # Entries whose files were all removed since the last scan. Folder
+        # entries that only lost the frame they had as cover take the first
+        # frame left instead.
+        removed = set()
+        for file in old_manifest.files:
+            if file not in manifest.files:
+                item = classify_file(self.db_dir, base + file)
+                if item is None:
+                    continue
+                path = item[0][len(self.db_dir):]
+                if path not in claimed:
+                    removed.add(path)
+                elif self.filepaths[path].cover_path == item[3] != "unknown":
+                    self.set_cover(self.filepaths[path], classify_file(self.db_dir, base + claimed[path])[3])
+        removed = [path for path in removed if path in self.filepaths]
+        self.remove_entries([self.filepaths[path].id for path in removed])
+        report["removed"] = removed
+        if (manifest.files != old_manifest.files or manifest.directories != old_manifest.directories
+                or manifest.fingerprints != old_manifest.fingerprints):
+            manifest.save(manifest_path)
+
         if bar is not None:
-            print("preset")
-            bar.setMaximum(total_files)
-            bar.setValue(current_file)
-            label.setText(str(current_file)+"/"+str(total_files))
-            print("post-set")
-
-        for file in all_files:
-            current_file += 1
-            file = file.replace("\\", "/")
-            # print(file)
-            if file[len(self.db_dir):][:len(CACHE_DIR)] == CACHE_DIR:
+            bar.setMaximum(1)
+            bar.setValue(1)
+            label.setText(str(walked) + " files")
+        print("FILES LOADED", report["added"], "added,", report["changed"], "changed,", report["moved"], "moved,",
+              len(removed), "removed")
+        return report
+
+    # Brings the entries of the files that changed (relative paths, as a
+    # watcher reports them) up to date without scanning the collection. New
+    # files are added, changed ones read again, new directories walked,
+    # moved entries moved along and entries left without any file removed.
+    # The scan manifest is kept up to date with them.
+    def update_files(self, files, workers: int = 1) -> dict:
+        report = {"added": 0, "changed": 0, "moved": 0, "removed": []}
+        base = scanner.base_dir(self.db_dir)
+        if not os.path.isdir(base):
+            print("Collection directory missing, not updated:", base)
+            return report
+        manifest_path = self.file_dir + scanner.MANIFEST_SUFFIX
+        manifest = scanner.load_manifest(manifest_path, self.db_dir)
+        ignored = self.ignored_files()
+        changed = False  # Whether the manifest needs saving
+
+        present = []
+        gone = []
+        for file in sorted(files):
+            if ignored(base + file):
                 continue
-            if "._" in file:
+            if os.path.lexists(base + file):
+                present.append(file)
+            elif file != "":
+                gone.append(file)
+        for file in gone:
+            changed = manifest.files.pop(file, None) is not None or changed
+            if file + "/" in manifest.directories:
+                folder = file + "/"
+                for table in (manifest.files, manifest.directories):
+                    for f in [f for f in table if f.startswith(folder)]:
+                        del table[f]
+                changed = True
+
+        # Entries of the files that are gone, and of those inside the
+        # directories that are. The ones other files still make up are read
+        # again from one of those, as their cover may have been one that's gone.
+        candidates = set()
+        for file in gone:
+            item = classify_file(self.db_dir, base + file)
+            if item is not None:
+                candidates.add(item[0][len(self.db_dir):])
+            candidates.update(entry.path for entry in self.folder_entries(file))
+        removed = []
+        refreshed = set()
+        for path in sorted(candidates):
+            if path not in self.filepaths:
                 continue
+            file = self.entry_file(path)
+            if file is None:
+                removed.append(path)
+            else:
+                present.append(file)
+                refreshed.add(file)
+
+        existing_entries = collections.deque()
+        claimed = set()
+
+        # Files whose size, mtime or inode changed, with the manifest updated
+        def changed_files():
+            nonlocal changed
+            for file in present:
+                path = base + file
+                if os.path.isdir(path) and not os.path.islink(path):
+                    walked = scanner.ScanManifest(self.db_dir)
+                    for f in scanner.scan(manifest, walked, ignored, file.rstrip("/") + "/"):
+                        if manifest.files.get(f) != walked.files[f]:
+                            manifest.files[f] = walked.files[f]
+                            changed = True
+                            yield f
+                    changed = changed or any(manifest.directories.get(d) != v for d, v in walked.directories.items())
+                    manifest.directories.update(walked.directories)
+                else:
+                    state = scanner.stat_file(path)
+                    if state is None:
+                        continue
+                    if manifest.files.get(file) != state:
+                        manifest.files[file] = state
+                        changed = True
+                    elif file not in refreshed:
+                        continue
+                    yield file
 
-            entry_name = file[file.rfind("/")+1:file.rfind(".")]
-            entry_ext = file[file.rfind(".")+1:]
-            entry_cover = "unknown"
-            entry_lang = "unknown"
-            entry_author = "unknown"
-            entry_res = (0, 0)
-            if entry_ext.lower() in SUPPORTED_IMAGE_FORMATS:
-                entry_cover = file
-            if entry_name.strip().replace("_", "").replace(".", "").isdigit():
-                file = file[:file.rfind("/")]
-                entry_name = file[file.rfind("/") + 1:]
-            if file[len(self.db_dir):] in self.filepaths:
-                print("skip file")
+        def tasks():
+            nonlocal changed
+            for file in changed_files():
+                item = classify_file(self.db_dir, base + file)
+                if item is None:
+                    continue
+                path = item[0][len(self.db_dir):]
+                if path in claimed:
+                    continue
+                claimed.add(path)
+                fingerprint = scanner.fingerprint(base + file)
+                if manifest.fingerprints.get(file) != fingerprint:
+                    manifest.fingerprints[file] = fingerprint
+                    changed = True
+                if path in self.filepaths:
+                    existing_entries.append(self.filepaths[path])
+                else:
+                    moved = self.moved_entry(manifest, fingerprint, claimed)
+                    if moved is not None:
+                        self.move_entry(moved, path)
+                        report["moved"] += 1
+                        continue
+                    existing_entries.append(None)
+                yield (self.db_dir, *item)
+
+        self.import_files(tasks(), existing_entries, workers, report)
+
+        removed = [path for path in removed if path in self.filepaths]
+        self.remove_entries([self.filepaths[path].id for path in removed])
+        report["removed"] = removed
+        if changed:
+            manifest.save(manifest_path)
+        print("FILES UPDATED", report["added"], "added,", report["changed"], "changed,", report["moved"], "moved,",
+              len(removed), "removed")
+        return report
+
+    # The entry whose first file had the fingerprint when the manifest was
+    # made, if that file is gone and no file makes up the entry any more.
+    # A file copied elsewhere leaves the entry where it is.
+    def moved_entry(self, manifest: scanner.ScanManifest, fingerprint, claimed):
+        if fingerprint is None:
+            return None
+        base = scanner.base_dir(self.db_dir)
+        for file in manifest.fingerprint_files().get(fingerprint, ()):
+            if os.path.lexists(base + file):
+                continue
+            item = classify_file(self.db_dir, base + file)
+            if item is None:
                 continue
-            elif entry_ext.lower() in SUPPORTED_VIDEO_FORMATS:
-                entry_cover = util.cache_video_cover(self.db_dir, CACHE_DIR, file)
-                entry_res = util.get_video_resolution(file)
-            elif entry_ext.lower() == "epub":
-                entry_cover = util.cache_epub_cover(self.db_dir, CACHE_DIR, file)
-                entry_name, entry_author, entry_lang = util.get_epub_metadata(file)
-            elif entry_ext.lower() in SUPPORTED_IMAGE_FORMATS:
-                entry_res = util.get_image_resolution(file)
-
-            entry = Entry(file[len(self.db_dir):], entry_cover, entry_name,
-                          entry_author, "unknown", 1, entry_lang, "NA", 0,
-                          entry_res, ["unknown"])
+            path = item[0][len(self.db_dir):]
+            if path not in claimed and path in self.filepaths and self.entry_file(path) is None:
+                return self.filepaths[path]
+        return None
 
-            self.add_entry(entry)
-            if bar is not None:
-                bar.setValue(current_file)
-                label.setText(str(current_file) + "/" + str(total_files))
-        print("FILES LOADED")
+    # A file that still makes up the entry, relative to the collection
+    # directory: the file itself, or a frame of a folder entry. None when
+    # there is none.
+    def entry_file(self, path: str):
+        file = self.db_dir + path
+        if not os.path.isdir(file):
+            return path if os.path.lexists(file) else None
+        try:
+            with os.scandir(file) as iterator:
+                for f in iterator:
+                    if f.is_dir(follow_symlinks=False):
+                        continue
+                    item = classify_file(self.db_dir, f.path)
+                    if item is not None and item[0][len(self.db_dir):] == path:
+                        return path + "/" + f.name
+        except OSError:
+            pass
+        return None
 
-    def save_as_file(self, filepath: str):
-        text = (
+    # Writing over the database file, the journals it now holds are named
+    def appl_records(self, journals=()):
+        yield (
             self.name + "\n" +
             self.db_dir + "\n\n" +
             str(self.app_associations) + "\n" +
             str(self.entry_count) + "\n"
         )
-
+        if len(journals) > 0:
+            yield JOURNAL_HEADER + " " + " ".join(journals) + "\n"
         for entry in self.entries:
-            text = (
-                text + "\n---\n\n"
-                + entry.path + "\n"
-                + entry.cover_path + "\n"
-                + entry.name + "\n"
-                + entry.author + "\n"
-                + entry.series + ", " + str(entry.vol) + "\n"
-                + entry.language + ", " + entry.age_rating + "\n"
-                + str(entry.release) + "\n"
-                + str(entry.resolution[0]) + "x" + str(entry.resolution[1]) + "\n"
-                + str(entry.tags)[1:-1].replace("'", "") + "\n"
-            )
-
-        with open(filepath, "w", encoding="utf-8") as file:
-            file.write(text)
+            yield format_entry(entry)
+
+    def save_as_file(self, filepath: str):
+        self.wait_compaction()
+        if filepath.endswith(SQLITE_SUFFIX):
+            import sqlite_database
+            sqlite_database.write_sqlite(filepath, self)
+            return
+        journals = []
+        overwritten = os.path.abspath(filepath) == os.path.abspath(self.file_dir)
+        if overwritten:
+            self.sync_journal()
+            paths = (self.journal_path + JOURNAL_OLD_SUFFIX, self.journal_path)
+            journals = [j for j in map(read_journal_id, paths) if j is not None]
+        write_appl(filepath, self.appl_records(journals))
+        if overwritten:
+            self.journals = journals
+            self.clear_journal()
+        self.save_snapshot(filepath)
 
     def set_app_associations(self, extension: str, app: str):
         self.app_associations[extension] = app
+        self.record("set_app_associations", extension, app)
+
+    def set_preferences(self, name: str, app_associations: dict):
+        self.name = name
+        self.app_associations = app_associations
+        self.record("set_preferences", name, app_associations)
 
     def set_cover(self, entry: Entry, cover: str):
-        entry.cover_path = cover
+        self.update_entry(entry, cover_path=cover)
+        self.record("set_cover", entry.path, cover)
+
+    # Covers that were the entry's own file, or a frame of it, move with it
+    def move_entry(self, entry: Entry, path: str):
+        old_path = entry.path
+        cover = entry.cover_path
+        old_file = self.db_dir + old_path
+        if cover == old_file or cover.startswith(old_file + "/"):
+            cover = self.db_dir + path + cover[len(old_file):]
+        self.update_entry(entry, path=path, cover_path=cover)
+        self.record("move_entry", old_path, path)
 
     def set_name(self, entry: Entry, name: str):
-        entry.name = name
+        self.update_entry(entry, name=name)
+        self.record("set_name", entry.path, name)
 
     def set_author(self, entry: Entry, author: str):
-        util.dictionary_list_remove(self.authors, entry.author.lower(), entry)
-        entry.author = author
-        util.dictionary_list_add(self.authors, entry.author.lower(), entry)
+        self.update_entry(entry, author=self.intern(author))
+        self.record("set_author", entry.path, author)
 
     def set_series(self, entry: Entry, series: str):
-        util.dictionary_list_remove(self.series, entry.series.lower(), entry)
-        entry.series = series
-        util.dictionary_list_add(self.series, entry.series.lower(), entry)
+        self.update_entry(entry, series=self.intern(series))
+        self.record("set_series", entry.path, series)
 
     def set_vol(self, entry: Entry, vol: int):
-        entry.vol = vol
+        self.update_entry(entry, vol=vol)
+        self.record("set_vol", entry.path, vol)
 
     def set_language(self, entry: Entry, language: str):
-        util.dictionary_list_remove(self.languages, entry.language.lower(), entry)
-        entry.language = language
-        util.dictionary_list_add(self.languages, entry.language.lower(), entry)
+        self.update_entry(entry, language=self.intern(language))
+        self.record("set_language", entry.path, language)
 
     def set_rating(self, entry: Entry, age_rating: str):
-        util.dictionary_list_remove(self.age_ratings, entry.age_rating.lower(), entry)
-        entry.age_rating = age_rating
-        util.dictionary_list_add(self.age_ratings, entry.age_rating.lower(), entry)
+        self.update_entry(entry, age_rating=self.intern(age_rating))
+        self.record("set_rating", entry.path, age_rating)
 
     def set_release(self, entry: Entry, release: int):
-        entry.release = release
+        self.update_entry(entry, release=release)
+        self.record("set_release", entry.path, release)
 
     def set_resolution(self, entry: Entry, x: int, y:int):
-        entry.resolution = (x, y)
+        self.update_entry(entry, resolution=self.intern((x, y)))
+        self.record("set_resolution", entry.path, x, y)
 
     def add_tag(self, entry: Entry, tag: str):
-        util.dictionary_list_add(self.tags, tag.lower(), entry)
-        entry.tags.append(tag)
+        self.update_entry(entry, tags=entry.tags + [self.intern(tag)])
+        self.record("add_tag", entry.path, tag)
 
     def remove_tag(self, entry: Entry, tag: str):
-        util.dictionary_list_remove(self.tags, tag.lower(), entry)
-        entry.tags.remove(tag)
+        tags = list(entry.tags)
+        tags.remove(tag)
+        self.update_entry(entry, tags=tags)
+        self.record("remove_tag", entry.path, tag)
 
     def set_tags(self, entry: Entry, tags: str):
-        for t in entry.tags:
-            util.dictionary_list_remove(self.tags, t.lower(), entry)
-        entry.tags = []
-        new_tags = [t.strip() for t in tags.split(",")]
-        for t in new_tags:
-            self.add_tag(entry, t)
+        self.update_entry(entry, tags=[self.intern(t.strip()) for t in tags.split(",")])
+        self.record("set_tags", entry.path, tags)
+
+    # Interning
+    # Only values of this database's entries are kept, so the table goes
+    # with it, and is made again from the entries whenever they're read
+    def intern(self, value):
+        return self.interned.setdefault(value, value)
+
+    def intern_entry(self, entry: Entry):
+        interned = self.interned
+        entry.author = interned.setdefault(entry.author, entry.author)
+        entry.series = interned.setdefault(entry.series, entry.series)
+        entry.language = interned.setdefault(entry.language, entry.language)
+        entry.age_rating = interned.setdefault(entry.age_rating, entry.age_rating)
+        entry.resolution = interned.setdefault(entry.resolution, entry.resolution)
+        entry.tags = [interned.setdefault(t, t) for t in entry.tags]
+
+    # Index Maintenance
+    # Without fields every index is updated, otherwise only those built
+    # from one of the fields
+    def index_entry(self, entry: Entry, fields=None):
+        for index in INDEXES:
+            if fields is None or not index.fields.isdisjoint(fields):
+                index.add(self, entry)
+
+    def unindex_entry(self, entry: Entry, fields=None):
+        for index in INDEXES:
+            if fields is None or not index.fields.isdisjoint(fields):
+                index.remove(self, entry)
+
+    # Entry fields are only ever changed through here, between taking the
+    # entry out of the indexes built from them and putting it back
+    def update_entry(self, entry: Entry, **values):
+        self.generation += 1
+        self.unindex_entry(entry, values)
+        for field, value in values.items():
+            setattr(entry, field, value)
+        if "name" in values or "path" in values:
+            entry.update_keys()
+        self.index_entry(entry, values)
 
     def remove_entry(self, entry: Entry):
-        self.entries.remove(entry)
-        util.dictionary_list_remove(self.authors, entry.author, entry)
-        util.dictionary_list_remove(self.series, entry.series, entry)
-        util.dictionary_list_remove(self.languages, entry.language, entry)
-        util.dictionary_list_remove(self.age_ratings, entry.age_rating, entry)
-        for tag in entry.tags:
-            util.dictionary_list_remove(self.tags, tag, entry)
-        self.entry_count -= 1
+        self.remove_entries([entry.id])
 
-    def search(self, query: str):
-        query = query.strip()
-        words = list(util.powerset(query.split(" "))[1:])
-        print(words)
+    # Removing many entries at once filters the range indexes just once
+    def remove_entries(self, ids):
+        entries = [self.entries_by_id[i] for i in dict.fromkeys(ids) if self.entries_by_id[i] is not None]
+        if len(entries) <= 0:
+            return
+        self.generation += 1
 
-        output_dict = dict()
-        filtered_set = set(self.entries)
+        # Rebuilding the text indexes later beats unindexing most of them
+        if len(entries) * TEXT_INDEX_REBUILD > len(self.entries):
+            self.drop_text_index()
+        for entry in entries:
+            self.entries.remove(entry)
+            self.entries_by_id[entry.id] = None
+            self.ids.remove(entry.id)
+            self.entry_count -= 1
+            self.record("remove_entry", entry.path)
+        for index in INDEXES:
+            index.remove_many(self, entries)
 
-        for word in words:
-            word = word.lower().strip()
+    # Journal
+    # A line of JSON per change, naming entries by path as ids aren't kept
+    # in the file. Lines are fsynced in batches, and once the journal grows
+    # large it's compacted into a freshly written APPL file.
+    def record(self, *change):
+        if not self.journaling:
+            return
+        if self.journal is None:
+            self.journal = open(self.journal_path, "a", encoding="utf-8")
+            if self.journal.tell() <= 0:
+                line = json.dumps([JOURNAL_HEADER, os.urandom(8).hex()]) + "\n"
+                self.journal.write(line)
+                self.journal_size += len(line)
+        line = json.dumps(change, ensure_ascii=False) + "\n"
+        self.journal.write(line)
+        self.journal_pending += 1
+        self.journal_size += len(line)
+        if self.journal_pending >= JOURNAL_SYNC_COUNT:
+            self.sync_journal()
+        if self.journal_size >= JOURNAL_COMPACT_SIZE:
+            self.compact()
+
+    def sync_journal(self):
+        if self.journal is None or self.journal_pending <= 0:
+            return
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_pending = 0
+
+    def close_journal(self):
+        if self.journal is None:
+            return
+        self.sync_journal()
+        self.journal.close()
+        self.journal = None
+
+    # Once written, the file holds every change, so the journal is dropped
+    def clear_journal(self):
+        self.close_journal()
+        for path in (self.journal_path, self.journal_path + JOURNAL_OLD_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+        self.journal_size = 0
+
+    # Replaying tolerates changes the file already holds, as when a journal
+    # from before ids outlived the file written over it
+    def replay_journal(self, path: str):
+        if read_journal_id(path) in self.journals:
+            return
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    change, *args = json.loads(line)
+                except ValueError:
+                    continue  # Cut off mid-write
+                if change == JOURNAL_HEADER:
+                    continue
+                if change == "set_app_associations":
+                    self.set_app_associations(*args)
+                elif change == "set_preferences":
+                    self.set_preferences(*args)
+                elif change == "add_entry":
+                    if args[0] not in self.filepaths:
+                        self.add_entry(Entry(*args[:9], (args[9], args[10]), args[11]))
+                elif args[0] in self.filepaths:
+                    entry = self.filepaths[args[0]]
+                    if change == "remove_entry":
+                        self.remove_entry(entry)
+                    elif change == "add_tag" and args[1] in entry.tags:
+                        continue
+                    elif change == "remove_tag" and args[1] not in entry.tags:
+                        continue
+                    elif change == "move_entry" and args[1] in self.filepaths:
+                        continue
+                    elif change in JOURNAL_ENTRY_CHANGES:
+                        getattr(self, change)(entry, *args[1:])
+
+    # The journal is set aside for the compacting thread to drop, and new
+    # changes start a new one
+    def compact(self):
+        old_journal = self.journal_path + JOURNAL_OLD_SUFFIX
+        if (self.compaction is not None and self.compaction.is_alive()) or os.path.exists(old_journal):
+            return
+        self.close_journal()
+        os.replace(self.journal_path, old_journal)
+        self.journal_size = 0
+        journals = [j for j in (read_journal_id(old_journal),) if j is not None]
+        self.compaction = threading.Thread(target=write_compacted,
+                                           args=(self.file_dir, list(self.appl_records(journals)), old_journal),
+                                           daemon=True)
+        self.compaction.start()
+
+    def wait_compaction(self):
+        if self.compaction is not None:
+            self.compaction.join()
+            self.compaction = None
+
+    def close(self):
+        self.wait_compaction()
+        self.close_journal()
 
-            if word.count("[") > 1:
+    # Text Indexes
+    # The token, trigram and fuzzy indexes are only needed to search, so
+    # they aren't built on load. They're built a chunk of entries at a time,
+    # for up to budget seconds a call, and until then searches check the
+    # entries they don't hold yet directly. True once they hold every entry.
+    def build_text_index(self, budget: float = None) -> bool:
+        if self.text_indexed:
+            return True
+        end = None if budget is None else time.perf_counter() + budget
+        text_indexes = [i for i in INDEXES if isinstance(i, TextIndex)]
+        while self.text_cursor < len(self.entries_by_id):
+            chunk = self.entries_by_id[self.text_cursor:self.text_cursor + TEXT_INDEX_CHUNK]
+            self.text_cursor += len(chunk)
+            for entry in chunk:
+                if entry is not None:
+                    for index in text_indexes:
+                        index.insert(self, entry)
+            if end is not None and time.perf_counter() >= end:
+                return False
+        # Typos were only corrected against part of the entries until now
+        self.generation += 1
+        self.text_indexed = True
+        return True
+
+    def drop_text_index(self):
+        self.tokens = dict()
+        self.trigrams = dict()
+        self.fuzzy = util.FuzzyIndex()
+        self.text_indexed = False
+        self.text_cursor = 0
+
+    def unindexed_entries(self):
+        if self.text_indexed:
+            return []
+        return [e for e in self.entries_by_id[self.text_cursor:] if e is not None]
+
+    # Entries that could contain the text in their name or path
+    def substring_candidates(self, text: str):
+        if len(text) < 3:
+            return self.token_candidates(text)
+
+        postings = []
+        for trigram in util.trigrams(text):
+            if trigram not in self.trigrams:
+                return set()
+            postings.append(self.trigrams[trigram])
+        postings.sort(key=len)
+
+        candidates = set(postings[0])
+        for p in postings[1:]:
+            candidates.intersection_update(p)
+            if len(candidates) <= 0:
+                break
+        return candidates
+
+    # Entries that could contain the text somewhere in their searchable fields
+    def token_candidates(self, text: str):
+        candidates = None
+        for token in util.tokenize(text):
+            matches = set()
+            for key, postings in self.tokens.items():
+                if token in key:
+                    matches.update(postings)
+            candidates = matches if candidates is None else candidates & matches
+            if len(candidates) <= 0:
+                break
+        return candidates
+
+    # Ids of the entries with a facet value equal to the text
+    def facet_matches(self, text: str) -> util.Bitmap:
+        output = util.Bitmap()
+        for facet in (self.tags, self.languages, self.authors, self.series, self.age_ratings, self.extensions):
+            if text in facet:
+                output = output | facet[text]
+        return output
+
+    # Facet Counts
+    # (value, label, entries) of a facet, most common first and leaving out
+    # values no entry holds. Counts for the whole library are kept up to
+    # date by FacetIndex, those within a query's results are tallied from
+    # the results, once per generation.
+    def facet_counts(self, facet: str, query: str = "") -> list:
+        query = " ".join(query.split())
+        counts = self.value_counts[facet] if query == "" else self.result_counts(query)[facet]
+        labels = self.value_labels[facet]
+        output = [(k, labels.get(k, k), c) for k, c in counts.items() if c > 0]
+        output.sort(key=lambda v: (-v[2], v[0]))
+        return output
+
+    def result_counts(self, query: str) -> dict:
+        counts = self.query_cache.get(("counts", query), self.generation)
+        if counts is not None:
+            return counts
+
+        # Facets with few values intersect their bitmaps with the results,
+        # the rest are counted entry by entry
+        ranked = self.query_ranked(query)
+        results = util.Bitmap(i for _, i in ranked)
+        counts = dict()
+        facet_indexes = []
+        for index in INDEXES:
+            if not isinstance(index, FacetIndex):
                 continue
-            filtered = "[" == word[0] and "]" == word[-1]
-            temp_filtered_set = set()
-            word = word.replace("[", "").replace("]", "")
-
-            if word in self.tags:
-                for entry in self.tags[word]:
-                    if filtered and entry in filtered_set:
-                        temp_filtered_set.add(entry)
-                    if entry not in output_dict:
-                        output_dict[entry] = 1
-                    else:
-                        output_dict[entry] += 1
-            if word in self.languages:
-                for entry in self.languages[word]:
-                    if filtered and entry in filtered_set:
-                        temp_filtered_set.add(entry)
-                    if entry not in output_dict:
-                        output_dict[entry] = 1
-                    else:
-                        output_dict[entry] += 1
-            if word in self.authors:
-                for entry in self.authors[word]:
-                    if filtered and entry in filtered_set:
-                        temp_filtered_set.add(entry)
-                    if entry not in output_dict:
-                        output_dict[entry] = 1
-                    else:
-                        output_dict[entry] += 1
-            if word in self.series:
-                for entry in self.series[word]:
-                    if filtered and entry in filtered_set:
-                        temp_filtered_set.add(entry)
-                    if entry not in output_dict:
-                        output_dict[entry] = 1
-                    else:
-                        output_dict[entry] += 1
-            if word in self.age_ratings:
-                for entry in self.age_ratings[word]:
-                    if filtered and entry in filtered_set:
-                        temp_filtered_set.add(entry)
-                    if entry not in output_dict:
-                        output_dict[entry] = 1
-                    else:
-                        output_dict[entry] += 1
-            if word in self.extensions:
-                for entry in self.extensions[word]:
-                    if filtered and entry in filtered_set:
-                        temp_filtered_set.add(entry)
-                    if entry not in output_dict:
-                        output_dict[entry] = 1
-                    else:
-                        output_dict[entry] += 1
+            facet = getattr(self, index.attribute)
+            if len(facet) * FACET_INTERSECT_COST < len(ranked):
+                counts[index.attribute] = {k: len(ids & results) for k, ids in facet.items()}
+            else:
+                counts[index.attribute] = dict()
+                facet_indexes.append(index)
+        if len(facet_indexes) > 0:
+            for _, i in ranked:
+                entry = self.entries_by_id[i]
+                for index in facet_indexes:
+                    facet = counts[index.attribute]
+                    for key in index.keys(entry):
+                        facet[key] = facet.get(key, 0) + 1
+        self.query_cache.put(("counts", query), counts, self.generation, sum(len(c) for c in counts.values()))
+        return counts
 
-            for entry in self.entries:
-                name = entry.name.lower()
-                if word in name:
-                    if entry not in output_dict:
-                        output_dict[entry] = 1
-                    else:
-                        output_dict[entry] += 1
-                path = entry.path.lower()
-                if word in path:
-                    if entry not in output_dict:
-                        output_dict[entry] = 1
-                    else:
-                        output_dict[entry] += 1
-
-            if filtered:
-                filtered_set = temp_filtered_set
-
-        output_dict = {key: value for key, value in sorted(output_dict.items(), key=lambda item: item[1], reverse=True)}
-        print(output_dict)
-        output_list = []
-        for k in output_dict.keys():
-            if k in filtered_set:
-                output_list.append(k)
-        print(output_list)
-
-        return output_list
+    # Folders
+    # Entries under a folder are read from the directory tree, so a
+    # subtree costs its own size rather than a scan of every entry
+    # The directory tree is only needed to browse, so it's built when first used
+    def directory_tree(self) -> util.Trie:
+        if not self.directories_built:
+            self.directories_built = True
+            directory_indexes = [i for i in INDEXES if isinstance(i, DirectoryIndex)]
+            with collector_paused():
+                for entry in self.entries:
+                    for index in directory_indexes:
+                        index.add(self, entry)
+        return self.directories
+
+    def folder_entries(self, folder: str):
+        return self.directory_tree().list_after(folder, "/")
+
+    def folder_count(self, folder: str) -> int:
+        return self.directory_tree().count(folder, "/")
+
+    def path_matches(self, folder: str) -> util.Bitmap:
+        return util.Bitmap(e.id for e in self.folder_entries(folder))
+
+    # ([(name, entry count, entries by extension)], entries) directly inside the folder
+    def browse(self, folder: str):
+        return self.directory_tree().children(folder, "/")
+
+    # Entries with the phrase in their name or path. While typing, the
+    # phrase extends one that was just searched, so only those matches
+    # need to be checked again. Short phrases match much of the library,
+    # where checking their matches again saves little, so only smaller
+    # match sets are kept.
+    def phrase_matches(self, phrase: str) -> set:
+        found = self.phrase_cache.get(phrase, self.generation)
+        if found is not None:
+            return found
+
+        candidates = None
+        for end in range(len(phrase) - 1, 0, -1):
+            candidates = self.phrase_cache.get(phrase[:end], self.generation)
+            if candidates is not None:
+                break
+        if candidates is None:
+            candidates = self.substring_candidates(phrase)
+            if candidates is not None:
+                candidates = itertools.chain(candidates, self.unindexed_entries())
+        if candidates is None:
+            candidates = self.entries
+
+        found = {e for e in candidates if phrase in e.name_key or phrase in e.path_key}
+        if len(found) <= PHRASE_CACHE_MATCHES:
+            self.phrase_cache.put(phrase, found, self.generation, len(found))
+        return found
+
+    # Scores every contiguous phrase of the words found in facets, names and paths
+    def score_phrases(self, words: list, scores: dict, filtered_set=None):
+        for i in range(len(words)):
+            for j in range(i, len(words)):
+                phrase = " ".join(words[i:j+1])
+
+                matches = self.facet_matches(phrase)
+                if filtered_set is not None:
+                    matches = matches & filtered_set
+                for k in matches:
+                    scores[k] = scores.get(k, 0) + 1
+
+                for entry in self.phrase_matches(phrase):
+                    if filtered_set is not None and entry.id not in filtered_set:
+                        continue
+                    if phrase in entry.name_key:
+                        scores[entry.id] = scores.get(entry.id, 0) + 1
+                    if phrase in entry.path_key:
+                        scores[entry.id] = scores.get(entry.id, 0) + 1
+
+    # Heap of (-score, id), holding every filtered id, or every scored id
+    # when nothing was filtered
+    def rank(self, scores: dict, filtered_set) -> list:
+        if filtered_set is not None:
+            ranked = [(-scores.get(i, 0), i) for i in filtered_set]
+        else:
+            ranked = [(-score, i) for i, score in scores.items()]
+        heapq.heapify(ranked)
+        return ranked
+
+    def ranked_entries(self, ranked: list) -> list:
+        return [self.entries_by_id[i] for _, i in sorted(ranked)]
+
+    def pop_ranked(self, ranked: list):
+        while len(ranked) > 0:
+            yield self.entries_by_id[heapq.heappop(ranked)[1]]
+
+    # Entries holding a word, or a typo or two away from it, outside of
+    # what score_phrases matched score a fraction of a point
+    def score_fuzzy(self, words: list, scores: dict, filtered_set=None):
+        if not self.fuzzy_search:
+            return
+        for word in words:
+            for token in util.tokenize(word):
+                if len(token) < FUZZY_MIN_LENGTH or not fuzzy_token(token):
+                    continue
+                max_distance = 1 if len(token) < 8 else 2
+                for term, distance in self.fuzzy.lookup(token, max_distance).items():
+                    for entry in self.tokens.get(term, []):
+                        if filtered_set is not None and entry.id not in filtered_set:
+                            continue
+                        scores[entry.id] = scores.get(entry.id, 0) + FUZZY_WEIGHT / (distance + 1)
+
+    def search(self, query: str):
+        query = " ".join(util.normalize(query).split())
+        packed = self.query_cache.get(("search", query), self.generation)
+        if packed is not None:
+            return self.ranked_entries(unpack_ranked(packed))
+
+        filters = [f.strip() for f in re.findall(r"\[([^\]]*)\]", query)]
+        words = re.sub(r"\[[^\]]*\]", " ", query).split()
+        ranges = [q.parse_range(word) for word in words]
+        filters.extend(r for r in ranges if r is not None)
+        words = [word for word, r in zip(words, ranges) if r is None]
+
+        scores = dict()
+        filtered_set = None
+
+        # [Tag] and release:2010..2015 Filters
+        for word in filters:
+            matches = word.evaluate(self, None) if isinstance(word, q.Range) else self.facet_matches(word)
+            filtered_set = matches if filtered_set is None else filtered_set & matches
+            if not filtered_set:
+                break
+        if filtered_set:
+            for word in filters:
+                if isinstance(word, q.Range):
+                    continue
+                for facet in (self.tags, self.languages, self.authors, self.series, self.age_ratings, self.extensions):
+                    if word in facet:
+                        for i in facet[word] & filtered_set:
+                            scores[i] = scores.get(i, 0) + 1
+
+            self.score_phrases(words, scores, filtered_set)
+            self.score_fuzzy(words, scores, filtered_set)
+        elif filtered_set is None:
+            self.score_phrases(words, scores, filtered_set)
+            self.score_fuzzy(words, scores, filtered_set)
+
+        ranked = self.rank(scores, filtered_set)
+        self.query_cache.put(("search", query), pack_ranked(ranked), self.generation, len(ranked))
+        return self.ranked_entries(ranked)
+
+    def query_ranked(self, text: str) -> list:
+        plan = q.Query(text)
+        packed = self.query_cache.get(("query", plan.key()), self.generation)
+        if packed is not None:
+            return unpack_ranked(packed)
+
+        scores = dict()
+        filtered_set = None
+        if plan.constraint is not None:
+            filtered_set = plan.constraint.evaluate(self, None)
+        if filtered_set is None or filtered_set:
+            for words in plan.phrases:
+                self.score_phrases(words, scores, filtered_set)
+            self.score_fuzzy(plan.words, scores, filtered_set)
+
+        ranked = self.rank(scores, filtered_set)
+        self.query_cache.put(("query", plan.key()), pack_ranked(ranked), self.generation, len(ranked))
+        return ranked
+
+    def query(self, text: str) -> list:
+        return self.ranked_entries(self.query_ranked(" ".join(text.split())))
+
+    # Results are popped off the heap as they are fetched
+    def query_cursor(self, text: str) -> ResultCursor:
+        ranked = self.query_ranked(" ".join(text.split()))
+        return ResultCursor(self.pop_ranked(ranked), len(ranked))
+
+    def top(self, text: str, count: int) -> list:
+        return self.query_cursor(text).fetch(count)
+
+    def cache_stats(self) -> dict:
+        return self.query_cache.stats()
 
     def print(self):
         print(self.file_dir)
         print(self.name)
         print(self.db_dir)
         print(self.app_associations)
-        print(self.entries)
+        print(list(self.entries))
         print("-")
         print("Tags: ", self.tags)
         print("Authors: ", self.authors)
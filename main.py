@@ -6,7 +6,7 @@
 # Media Organizer for Local Files w/o Changing File Structures
 #
 #
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QIcon, QKeySequence, QPixmap, QImage
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow,
@@ -18,14 +18,21 @@ from PyQt5.QtWidgets import (
     QDialog, QFileDialog, QInputDialog,
 )
 from functools import partial
+import multiprocessing
 import subprocess
 import sys
 import os
 
 import database as db
 import qt_util
+import watcher
 
 ENTRY_LISTING_HEIGHT = 60
+ENTRY_PAGE_SIZE = 100
+JOURNAL_SYNC_INTERVAL = 1000
+WATCH_INTERVAL = 500
+SEARCH_DELAY = 150  # Milliseconds without typing before searching
+TEXT_INDEX_BUDGET = 0.02  # Seconds of building the search indexes between events
 DEFAULT_APP_ASSOCIATIONS = {"mp3": "vlc", "txt": "vim"}
 
 
@@ -33,9 +40,13 @@ class MainWindow(QMainWindow):
     def __init__(self, app: QApplication):
         super().__init__()
         self.screen = app.primaryScreen()
-        self.database: db.Database = db.Database("default.appl")
+        self.database: db.Database = db.open_database("default.appl")
         self.entries = []
+        self.results = db.ResultCursor([], 0)
         self.entry: db.Entry = self.database.entries[0]
+        self.folder = None  # Folder being browsed, or None when not browsing
+        self.watcher = None  # Watches the collection directory while watching is on
+        self.loading = False  # While files are being loaded
 
         self.setWindowTitle("MediAppl")
         self.setWindowIcon(QIcon('res/Icon.png'))
@@ -66,6 +77,11 @@ class MainWindow(QMainWindow):
         button_reload.setShortcut(QKeySequence("Ctrl+r"))
         button_reload.triggered.connect(self.reload_database)
 
+        self.button_watch = QAction("Watch Folder", self)
+        self.button_watch.setStatusTip("Keep the Database Up to Date with its Folder")
+        self.button_watch.setCheckable(True)
+        self.button_watch.toggled.connect(self.toggle_watch)
+
         button_edit = QAction("Edit", self)
         button_edit.setStatusTip("Edit Current Entry")
         button_edit.setShortcut(QKeySequence("Ctrl+e"))
@@ -106,6 +122,12 @@ class MainWindow(QMainWindow):
         button_tags.setStatusTip("Filter Tags")
         button_tags.triggered.connect(self.search_tags)
 
+        self.button_browse = QAction("Browse Folders", self)
+        self.button_browse.setStatusTip("Browse Entries by Folder")
+        self.button_browse.setShortcut(QKeySequence("Ctrl+b"))
+        self.button_browse.setCheckable(True)
+        self.button_browse.toggled.connect(self.toggle_browse)
+
         # Create Menu
         menu = self.menuBar()
 
@@ -116,6 +138,7 @@ class MainWindow(QMainWindow):
         file_menu.addAction(button_save)
         file_menu.addAction(button_save_as)
         file_menu.addAction(button_reload)
+        file_menu.addAction(self.button_watch)
         file_menu.addSeparator()
         file_menu.addAction(button_preferences)
 
@@ -131,6 +154,8 @@ class MainWindow(QMainWindow):
         filter_menu.addAction(button_languages)
         filter_menu.addAction(button_ratings)
         filter_menu.addAction(button_tags)
+        filter_menu.addSeparator()
+        filter_menu.addAction(self.button_browse)
 
         # Create Status Bar
         self.setStatusBar(QStatusBar(self))
@@ -140,12 +165,20 @@ class MainWindow(QMainWindow):
         self.input_dbSearchbar = QLineEdit("")
         self.input_dbSearchbar.setPlaceholderText("Search")
         self.input_dbSearchbar.returnPressed.connect(self.search_entries)
+        self.input_dbSearchbar.textChanged.connect(self.search_live)
+        self.last_query = None
+        self.searched_early = False
+        # While typing, the search waits for a pause
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.timeout.connect(self.search_entries)
 
         self.list_dbEntries = QListWidget()
         self.list_dbEntries.setSelectionMode(QAbstractItemView.SingleSelection)
-        self.list_dbEntries.itemActivated.connect(self.open_entry)
-        self.list_dbEntries.itemDoubleClicked.connect(self.open_entry)
+        self.list_dbEntries.itemActivated.connect(self.activate_item)
+        self.list_dbEntries.itemDoubleClicked.connect(self.activate_item)
         self.list_dbEntries.itemSelectionChanged.connect(self.switch_entry_keyboard)
+        self.list_dbEntries.verticalScrollBar().valueChanged.connect(self.scroll_entries)
 
         self.vbox_db = QVBoxLayout()
         self.vbox_db.addWidget(self.label_dbName)
@@ -211,6 +244,25 @@ class MainWindow(QMainWindow):
         layout_container.setLayout(hbox_main)
         self.setCentralWidget(layout_container)
 
+        # Search indexes are built a little at a time whenever the window is idle
+        self.text_index_timer = QTimer(self)
+        self.text_index_timer.timeout.connect(self.build_text_index)
+        self.text_index_timer.start()
+
+        # Edits are journaled, and flushed to disk every second
+        self.journal_timer = QTimer(self)
+        self.journal_timer.timeout.connect(lambda: self.database.sync_journal())
+        self.journal_timer.start(JOURNAL_SYNC_INTERVAL)
+
+        # While watching, settled changes to the folder are picked up twice a second
+        self.watch_timer = QTimer(self)
+        self.watch_timer.timeout.connect(self.update_watched)
+
+    def closeEvent(self, event):
+        self.stop_watch()
+        self.database.close()
+        super().closeEvent(event)
+
     def new_database(self):
         print("New Database")
         db_path = QFileDialog.getExistingDirectory(self, "Select Folder")
@@ -222,35 +274,40 @@ class MainWindow(QMainWindow):
         appl_path = db_path+"/"+name+".appl"
         with open(appl_path, "w", encoding="utf-8") as file:
             file.write(name+"\n"+db_path+"/\n\n"+str(DEFAULT_APP_ASSOCIATIONS)+"\n0\n")
-        self.database = db.Database(appl_path)
+        self.stop_watch()
+        self.database.close()
+        self.database = db.open_database(appl_path)
         # self.database.load_files()
-        loading_dialog = qt_util.LoadingDialog(self.database)
-        loading_dialog.exec()
+        self.load_files()
         self.database.save_as_file(appl_path)
         self.update_ui()
+        self.toggle_watch(self.button_watch.isChecked())
 
     def load_database(self):
         print("Load Database")
         dialog = QFileDialog(self)
         dialog.setFileMode(QFileDialog.FileMode.ExistingFiles)
-        dialog.setNameFilter("Databases (*.appl)")
+        dialog.setNameFilter("Databases (*.appl *.appl.gz *.appl.xz *.sqlite)")
         if dialog.exec_():
             filepath = dialog.selectedFiles()[0]
-            self.database = db.Database(filepath)
+            self.stop_watch()
+            self.database.close()
+            self.database = db.open_database(filepath)
             self.database.clean_entries()
             self.entry = self.database.entries[0]
             print("pre update")
             self.update_ui()
+            self.toggle_watch(self.button_watch.isChecked())
 
     def save_database(self):
         print("Save Database")
-        self.database.save_as_file(self.database.file_dir)
+        self.database.sync_journal()
 
     def save_as_database(self):
         print("Save As Database")
         dialog = QFileDialog(self)
         dialog.setFileMode(QFileDialog.FileMode.AnyFile)
-        dialog.setNameFilter("Databases (*.appl)")
+        dialog.setNameFilter("Databases (*.appl *.appl.gz *.appl.xz *.sqlite)")
         dialog.setDirectory(self.database.db_dir)
         if dialog.exec_():
             filepath = dialog.selectedFiles()[0]
@@ -259,63 +316,140 @@ class MainWindow(QMainWindow):
     def reload_database(self):
         print("Reload Database From Disk")
         # self.database.load_files()
-        loading_dialog = qt_util.LoadingDialog(self.database)
-        loading_dialog.exec()
+        loading_dialog = self.load_files()
         self.update_ui()
+        if loading_dialog.report is not None:
+            self.show_report(loading_dialog.report)
+
+    # Loading hands control back to the event loop to show its progress, so
+    # nothing else may change the database until it's done
+    def load_files(self) -> qt_util.LoadingDialog:
+        self.loading = True
+        self.watch_timer.stop()
+        try:
+            loading_dialog = qt_util.LoadingDialog(self.database)
+            loading_dialog.exec()
+        finally:
+            self.loading = False
+            if self.watcher is not None:
+                self.watch_timer.start(WATCH_INTERVAL)
+        return loading_dialog
+
+    def show_report(self, report: dict):
+        self.statusBar().showMessage(str(report["added"]) + " added, " + str(report["changed"]) + " changed, "
+                                     + str(report["moved"]) + " moved, " + str(len(report["removed"])) + " removed")
+
+    def toggle_watch(self, checked: bool):
+        self.stop_watch()
+        if checked:
+            self.watcher = watcher.watch(self.database.db_dir, self.database.ignored_files())
+            self.watch_timer.start(WATCH_INTERVAL)
+
+    def stop_watch(self):
+        self.watch_timer.stop()
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    # Applies the changes the watcher has collected, rescanning when it lost track
+    def update_watched(self):
+        if self.loading:
+            return
+        paths = self.watcher.changes()
+        if paths is None:
+            report = self.database.load_files(None, None)
+        elif len(paths) > 0:
+            report = self.database.update_files(paths)
+        else:
+            return
+        if report["added"] + report["changed"] + report["moved"] + len(report["removed"]) <= 0:
+            return
+        if self.entry.path not in self.database.filepaths and len(self.database.entries) > 0:
+            self.entry = self.database.entries[0]
+        self.label_dbName.setText(self.database.name + " (" + str(self.database.entry_count) + ")")
+        self.search_entries()
+        self.update_entry_vbox()
+        self.show_report(report)
+        self.text_index_timer.start()
+
+    # Results found before the index was finished miss the word and typo
+    # matches of the entries it hadn't reached, so they're searched again
+    def build_text_index(self):
+        if self.loading:
+            return
+        if self.database.build_text_index(TEXT_INDEX_BUDGET):
+            self.text_index_timer.stop()
+            if self.searched_early and self.last_query != "":
+                self.search_entries()
+
+    def search_live(self, text: str):
+        if text.strip() == self.last_query:
+            self.search_timer.stop()
+            return
+        self.search_timer.start(SEARCH_DELAY)
 
     def search_entries(self):
+        self.search_timer.stop()
         query = self.input_dbSearchbar.text().strip()
+        self.last_query = query
+        self.searched_early = self.text_index_timer.isActive()
         print("Search: " + query)
 
+        if self.folder is not None and query == "":
+            self.browse_folder(self.folder)
+            return
+        query = self.current_query()
+
         if query == "":
-            output = self.database.entries
+            output = db.ResultCursor(self.database.entries, len(self.database.entries))
         else:
-            output = self.database.search(query)
+            output = self.database.query_cursor(query)
         print("Update entries")
         self.update_entries_scroll(output)
         print("Updated entries")
 
+    # The search, limited to the folder being browsed
+    def current_query(self) -> str:
+        query = self.input_dbSearchbar.text().strip()
+        if self.folder:
+            query = query + " path:\"" + self.folder + "\""
+        return query
+
     def search_filter(self):
         print("Search Filter")
-        tag_dialog = qt_util.FilterDialog(self.database, 0)
+        tag_dialog = qt_util.FilterDialog(self.database, 0, self.current_query())
         if tag_dialog.exec_():
             self.input_dbSearchbar.setText(self.input_dbSearchbar.text() + " " + tag_dialog.get_output())
-            self.search_entries()
 
     def search_authors(self):
         print("Search Authors")
-        tag_dialog = qt_util.FilterDialog(self.database, 0)
+        tag_dialog = qt_util.FilterDialog(self.database, 0, self.current_query())
         if tag_dialog.exec_():
             self.input_dbSearchbar.setText(self.input_dbSearchbar.text() + " " + tag_dialog.get_output())
-            self.search_entries()
 
     def search_series(self):
         print("Search Series")
-        tag_dialog = qt_util.FilterDialog(self.database, 1)
+        tag_dialog = qt_util.FilterDialog(self.database, 1, self.current_query())
         if tag_dialog.exec_():
             self.input_dbSearchbar.setText(self.input_dbSearchbar.text() + " " + tag_dialog.get_output())
-            self.search_entries()
 
     def search_languages(self):
         print("Search Languages")
-        tag_dialog = qt_util.FilterDialog(self.database, 2)
+        tag_dialog = qt_util.FilterDialog(self.database, 2, self.current_query())
         if tag_dialog.exec_():
             self.input_dbSearchbar.setText(self.input_dbSearchbar.text() + " " + tag_dialog.get_output())
-            self.search_entries()
 
     def search_ratings(self):
         print("Search Age Ratings")
-        tag_dialog = qt_util.FilterDialog(self.database, 3)
+        tag_dialog = qt_util.FilterDialog(self.database, 3, self.current_query())
         if tag_dialog.exec_():
             self.input_dbSearchbar.setText(self.input_dbSearchbar.text() + " " + tag_dialog.get_output())
-            self.search_entries()
 
     def search_tags(self):
         print("Search Tags")
-        tag_dialog = qt_util.FilterDialog(self.database, 4)
+        tag_dialog = qt_util.FilterDialog(self.database, 4, self.current_query())
         if tag_dialog.exec_():
             self.input_dbSearchbar.setText(self.input_dbSearchbar.text() + " " + tag_dialog.get_output())
-            self.search_entries()
 
     def search_selection(self, category: int):
         match category:
@@ -328,8 +462,30 @@ class MainWindow(QMainWindow):
             case 3:
                 self.input_dbSearchbar.setText(self.input_dbSearchbar.text() + " [" + self.entry.language + "]")
 
+    # Browsing
+    # The list shows the folders inside the current one, then its entries,
+    # and searches are limited to the folder
+    def toggle_browse(self, checked: bool):
+        self.folder = "" if checked else None
         self.search_entries()
 
+    def browse_folder(self, folder: str):
+        self.folder = folder
+        folders, entries = self.database.browse(folder)
+        items = []
+        if folder != "":
+            items.append(qt_util.FolderListing(self, folder[:folder.rfind("/")+1].rstrip("/"), "..", -1, dict()))
+        for name, count, kinds in folders:
+            items.append(qt_util.FolderListing(self, (folder + "/" + name).lstrip("/"), name, count, kinds))
+        self.update_entries_scroll(db.ResultCursor(entries, len(entries)), items)
+        self.label_dbName.setText(self.database.name + ": /" + folder + " (" + str(self.database.folder_count(folder)) + ")")
+
+    def activate_item(self, item):
+        if isinstance(item, qt_util.FolderListing):
+            self.browse_folder(item.folder)
+            return
+        self.open_entry()
+
     def open_entry(self):
         print("Open Entry")
         path = self.database.db_dir + self.entry.path
@@ -353,20 +509,25 @@ class MainWindow(QMainWindow):
 
     def update_ui(self):
         print("Update UI")
+        self.last_query = ""
         self.input_dbSearchbar.setText("")
         self.label_dbName.setText(self.database.name + " (" + str(self.database.entry_count) + ")")
-        self.update_entries_scroll(self.database.entries)
+        if self.folder is not None:
+            self.browse_folder("")
+        else:
+            self.update_entries_scroll(db.ResultCursor(self.database.entries, len(self.database.entries)))
         self.update_entry_vbox()
+        self.text_index_timer.start()
 
     def switch_entry(self, entry_item: qt_util.EntryListing):
         self.entry = entry_item.entry
         self.update_entry_vbox()
 
     def switch_entry_keyboard(self):
-        if len(self.entries) < 1:
+        item = self.list_dbEntries.currentItem()
+        if not isinstance(item, qt_util.EntryListing):
             return
-        index = self.list_dbEntries.currentIndex().row()
-        self.entry = self.entries[index]
+        self.entry = item.entry
         success = self.update_entry_vbox()
         print("entry Updated ", success)
 
@@ -395,33 +556,47 @@ class MainWindow(QMainWindow):
         # print("Unknown Cover")
         return False
 
-    def update_entries_scroll(self, entries):
+    def update_entries_scroll(self, results: db.ResultCursor, folders=()):
         print("Update Entries")
-        self.entries = entries
-        print(self.entries)
-        self.label_dbName.setText(self.database.name + " (" + str(len(self.entries)) + ")")
+        self.results = results
+        self.entries = []
+        self.label_dbName.setText(self.database.name + " (" + str(len(results)) + ")")
         print("Label Updated")
         self.list_dbEntries.clear()
         print("Entries cleared")
-
-        for e in entries:
+        for item in folders:
+            self.list_dbEntries.addItem(item)
+        self.fetch_entries()
+
+    # Only the entries scrolled into view are turned into list items
+    def fetch_entries(self):
+        for e in self.results.fetch(ENTRY_PAGE_SIZE):
+            self.entries.append(e)
             widget = qt_util.EntryListing(self, e)
             self.list_dbEntries.addItem(widget)
         print("entry list updated")
 
+    def scroll_entries(self, value: int):
+        if value >= self.list_dbEntries.verticalScrollBar().maximum() and len(self.entries) < len(self.results):
+            self.fetch_entries()
+
 
 #
 # Initialize Window
-application = QApplication(sys.argv)
-
-with open("style.qss", "r") as file:
-    stylesheet = file.read()
-    print(stylesheet)
-    application.setStyleSheet(stylesheet)
-
-# Create Window
-window = MainWindow(application)
-window.show()
-
-# Start the Program.
-application.exec()
\ No newline at end of file
+# Guarded, as the workers that import files start by importing this module
+# on platforms that spawn rather than fork them
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    application = QApplication(sys.argv)
+
+    with open("style.qss", "r") as file:
+        stylesheet = file.read()
+        print(stylesheet)
+        application.setStyleSheet(stylesheet)
+
+    # Create Window
+    window = MainWindow(application)
+    window.show()
+
+    # Start the Program.
+    application.exec()
@@ -104,6 +104,21 @@ class EntryListing(QListWidgetItem):
         self.setText("[" + self.entry.age_rating + "] " + self.entry.author + ": " + self.entry.name)
 
 
+# A folder while browsing, with how many entries are below it
+class FolderListing(QListWidgetItem):
+    def __init__(self, main_window, folder: str, name: str, count: int, kinds: dict):
+        super().__init__()
+        self.mw = main_window
+        self.folder = folder
+
+        if count < 0:
+            self.setText("[..] " + name)
+            return
+        self.setText("[" + str(count) + "] " + name + "/")
+        self.setToolTip(", ".join((k if k != "" else "folder") + ": " + str(v)
+                                  for k, v in sorted(kinds.items(), key=lambda i: -i[1])))
+
+
 class ClickLabel(QLabel):
     clicked = pyqtSignal()
 
@@ -117,6 +132,7 @@ class LoadingDialog(QDialog):
         self.setWindowTitle("Loading")
         self.setMinimumWidth(400)
         self.database = database
+        self.report = None
 
         self.bar = QProgressBar()
         self.bar.setObjectName("tags_tab")
@@ -133,7 +149,7 @@ class LoadingDialog(QDialog):
     def start(self):
         print("already")
         print("start_loading")
-        self.database.load_files(self.bar, self.label)
+        self.report = self.database.load_files(self.bar, self.label)
         self.accept()
 
 
@@ -171,30 +187,25 @@ class PreferencesDialog(QDialog):
         self.setLayout(layout)
 
     def apply(self):
-        self.database.name = self.input_name.text()
         dict_apps = {a.split(":")[0].strip(): a.split(":")[1].strip() for a in (self.text_apps.toPlainText()
                                                                                 .replace("\"", "")
                                                                                 .replace("'", "").split("\n"))}
-        self.database.app_associations = dict_apps
-        self.database.save_as_file(self.database.file_dir)
+        self.database.set_preferences(self.input_name.text(), dict_apps)
+        self.database.sync_journal()
         self.accept()
 
 
 class FilterDialog(QDialog):
-    def __init__(self, database: db.Database, start_tab: int, parent=None):
+    # Values are counted within the results of the query, most common first
+    def __init__(self, database: db.Database, start_tab: int, query: str = "", parent=None):
         super().__init__(parent)
         self.database = database
 
-        self.authors = list(self.database.authors.keys())
-        self.authors.sort()
-        self.series = list(self.database.series.keys())
-        self.series.sort()
-        self.languages = list(self.database.languages.keys())
-        self.languages.sort()
-        self.ratings = list(self.database.age_ratings.keys())
-        self.ratings.sort()
-        self.tags = list(self.database.tags.keys())
-        self.tags.sort()
+        self.authors = self.database.facet_counts("authors", query)
+        self.series = self.database.facet_counts("series", query)
+        self.languages = self.database.facet_counts("languages", query)
+        self.ratings = self.database.facet_counts("age_ratings", query)
+        self.tags = self.database.facet_counts("tags", query)
 
         self.output = set()
 
@@ -219,10 +230,10 @@ class FilterDialog(QDialog):
         widget_author.setObjectName("tags_tab")
         widget_author.setMinimumWidth(650)
         layout_author = FlowLayout()
-        for key in self.authors:
-            button_key = QPushButton(key)
+        for key, label, count in self.authors:
+            button_key = QPushButton(label + " (" + str(count) + ")")
             button_key.setCheckable(True)
-            button_key.clicked.connect(partial(self.toggle_output, key))
+            button_key.clicked.connect(partial(self.toggle_output, label))
             layout_author.addWidget(button_key)
         widget_author.setLayout(layout_author)
         scroll_author.setWidget(widget_author)
@@ -232,10 +243,10 @@ class FilterDialog(QDialog):
         widget_series.setObjectName("tags_tab")
         widget_series.setMinimumWidth(650)
         layout_series = FlowLayout()
-        for key in self.series:
-            button_key = QPushButton(key)
+        for key, label, count in self.series:
+            button_key = QPushButton(label + " (" + str(count) + ")")
             button_key.setCheckable(True)
-            button_key.clicked.connect(partial(self.toggle_output, key))
+            button_key.clicked.connect(partial(self.toggle_output, label))
             layout_series.addWidget(button_key)
         widget_series.setLayout(layout_series)
         scroll_series.setWidget(widget_series)
@@ -245,10 +256,10 @@ class FilterDialog(QDialog):
         widget_languages.setObjectName("tags_tab")
         widget_languages.setMinimumWidth(650)
         layout_languages = FlowLayout()
-        for key in self.languages:
-            button_key = QPushButton(key)
+        for key, label, count in self.languages:
+            button_key = QPushButton(label + " (" + str(count) + ")")
             button_key.setCheckable(True)
-            button_key.clicked.connect(partial(self.toggle_output, key))
+            button_key.clicked.connect(partial(self.toggle_output, label))
             layout_languages.addWidget(button_key)
         widget_languages.setLayout(layout_languages)
         scroll_languages.setWidget(widget_languages)
@@ -258,10 +269,10 @@ class FilterDialog(QDialog):
         widget_ratings.setObjectName("tags_tab")
         widget_ratings.setMinimumWidth(650)
         layout_ratings = FlowLayout()
-        for key in self.ratings:
-            button_key = QPushButton(key)
+        for key, label, count in self.ratings:
+            button_key = QPushButton(label + " (" + str(count) + ")")
             button_key.setCheckable(True)
-            button_key.clicked.connect(partial(self.toggle_output, key))
+            button_key.clicked.connect(partial(self.toggle_output, label))
             layout_ratings.addWidget(button_key)
         widget_ratings.setLayout(layout_ratings)
         scroll_ratings.setWidget(widget_ratings)
@@ -271,10 +282,10 @@ class FilterDialog(QDialog):
         widget_tags.setObjectName("tags_tab")
         widget_tags.setMinimumWidth(650)
         layout_tags = FlowLayout()
-        for key in self.tags:
-            button_key = QPushButton(key)
+        for key, label, count in self.tags:
+            button_key = QPushButton(label + " (" + str(count) + ")")
             button_key.setCheckable(True)
-            button_key.clicked.connect(partial(self.toggle_output, key))
+            button_key.clicked.connect(partial(self.toggle_output, label))
             layout_tags.addWidget(button_key)
         widget_tags.setLayout(layout_tags)
         scroll_tags.setWidget(widget_tags)
@@ -514,13 +525,13 @@ class EditDialog(QDialog):
 
     def apply(self):
         self.database.set_name(self.entry, self.input_name.text())
-        self.entry.cover_path = self.input_cover.text()
+        self.database.set_cover(self.entry, self.input_cover.text())
         self.database.set_author(self.entry, self.input_author.text())
         self.database.set_series(self.entry, self.input_series.text())
-        self.entry.vol = int(self.input_vol.text())
+        self.database.set_vol(self.entry, int(self.input_vol.text()))
         self.database.set_language(self.entry, self.input_language.text())
         self.database.set_rating(self.entry, self.input_rating.text())
-        self.entry.release = int(self.input_release.text())
-        self.entry.resolution = (int(self.input_res1.text()), int(self.input_res2.text()))
+        self.database.set_release(self.entry, int(self.input_release.text()))
+        self.database.set_resolution(self.entry, int(self.input_res1.text()), int(self.input_res2.text()))
         self.database.set_tags(self.entry, self.input_tags.text())
         self.accept()
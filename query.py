@@ -0,0 +1,422 @@
+import re
+
+import util
+
+#
+#
+# Query Language
+#
+# dragon sword          Scored words, as in Database.search
+# "dragon sword"        Scored phrase
+# [Sci-Fi Fantasy]      Required facet value
+# author:sanderson      Required field value (author, series, lang, rating, tag, ext)
+# release:2010..2015    Required range (release, vol, res), also res>=3840x2160
+# path:books/fantasy    Required folder, anywhere below it
+# -[unknown]            Excluded
+# [isekai] OR [sci-fi]  Either
+# ([a] OR [b]) [c]      Grouping
+#
+FIELDS = {
+    "author": "authors",
+    "series": "series",
+    "lang": "languages",
+    "language": "languages",
+    "rating": "age_ratings",
+    "tag": "tags",
+    "ext": "extensions",
+}
+
+RANGE_FIELDS = {
+    "release": "releases",
+    "vol": "vols",
+    "res": "resolutions",
+    "resolution": "resolutions",
+}
+
+# Bounds are kept to what SQLite integers hold
+RANGE_MIN = -2 ** 63
+RANGE_MAX = 2 ** 63 - 1
+
+RANGE_PATTERN = re.compile(r"(?i:(release|resolution|res|vol))(>=|<=|>|<|:)([0-9x.]*[0-9x])$")
+
+LEXER = re.compile(r"""
+    \s*(?:
+        (?P<open>\()
+      | (?P<close>\))
+      | (?P<bar>\|)
+      | (?P<not>-)(?=[\[("\w])
+      | (?P<range>(?i:release|resolution|res|vol)(?:>=|<=|>|<|:)[0-9x.]*[0-9x])(?=[\s()|]|$)
+      | (?P<field>(?i:author|series|language|lang|rating|tag|ext|path)):(?=[\["\w/])
+      | "(?P<phrase>[^"]*)"?
+      | \[(?P<facet>[^\]]*)\]
+      | (?P<partial>\[[^\]]*$)
+      | (?P<word>[^\s()\[\]"|]+)
+      | (?P<stray>\S)
+    )""", re.VERBOSE)
+
+
+def lex(text: str) -> list:
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = LEXER.match(text, position)
+        if match is None or match.end() == position:
+            break
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "word" and value == "OR":
+            kind = "bar"
+        if kind in ("partial", "stray"):  # An unfinished facet or a "]" without its "["
+            continue
+        tokens.append((kind, value))
+    return tokens
+
+
+#
+# Plan Nodes
+#
+# Every node can estimate how many entries it matches, and evaluate
+# to the bitmap of matching ids, limited to the ids in "within". For
+# SQLite databases, nodes compile to a condition and its parameters.
+# Nodes that match the same entries share a key, so however the query
+# was written, its results are cached once.
+#
+class Text:
+    def __init__(self, text: str, quoted: bool):
+        self.text = util.normalize(text).strip()
+        self.quoted = quoted
+
+    def key(self):
+        return "text", self.text
+
+    def estimate(self, database) -> int:
+        if len(self.text) < 3:
+            return database.entry_count
+        estimate = database.entry_count
+        for trigram in util.trigrams(self.text):
+            estimate = min(estimate, len(database.trigrams.get(trigram, [])))
+        return estimate
+
+    def evaluate(self, database, within):
+        output = database.facet_matches(self.text) | util.Bitmap(e.id for e in database.phrase_matches(self.text))
+        return output if within is None else output & within
+
+    def sql(self, database):
+        return database.text_sql(self.text)
+
+
+class Facet:
+    def __init__(self, value: str):
+        self.value = util.normalize(value).strip()
+
+    def key(self):
+        return "facet", self.value
+
+    def estimate(self, database) -> int:
+        return len(database.facet_matches(self.value))
+
+    def evaluate(self, database, within):
+        output = database.facet_matches(self.value)
+        return output if within is None else output & within
+
+    def sql(self, database):
+        return database.facet_sql(self.value)
+
+
+class Field:
+    def __init__(self, field: str, value: str):
+        self.facet = FIELDS[field.lower()]
+        self.value = util.normalize(value).strip()
+
+    def key(self):
+        return "field", self.facet, self.value
+
+    def matches(self, database) -> util.Bitmap:
+        facet = getattr(database, self.facet)
+        if self.value in facet:
+            return facet[self.value]
+        output = util.Bitmap()
+        for key, ids in facet.items():
+            if self.value in key:
+                output = output | ids
+        return output
+
+    def estimate(self, database) -> int:
+        facet = getattr(database, self.facet)
+        if self.value in facet:
+            return len(facet[self.value])
+        return database.entry_count
+
+    def evaluate(self, database, within):
+        output = self.matches(database)
+        return output if within is None else output & within
+
+    def sql(self, database):
+        return database.field_sql(self.facet, self.value)
+
+
+# Entries in a folder or below it, found through the directory tree
+class Path:
+    def __init__(self, folder: str):
+        self.folder = folder.strip().strip("/")
+
+    def key(self):
+        return "path", self.folder
+
+    def estimate(self, database) -> int:
+        return database.folder_count(self.folder)
+
+    def evaluate(self, database, within):
+        output = database.path_matches(self.folder)
+        return output if within is None else output & within
+
+    def sql(self, database):
+        return database.path_sql(self.folder)
+
+
+# Resolutions are compared by pixel count
+def range_value(field: str, text: str):
+    if text == "":
+        return None
+    if RANGE_FIELDS[field] == "resolutions" and "x" in text:
+        width, _, height = text.partition("x")
+        return int(width) * int(height)
+    return int(text)
+
+
+def parse_range(text: str):
+    match = RANGE_PATTERN.match(text.strip())
+    if match is None:
+        return None
+    field, operator, value = match.group(1).lower(), match.group(2), match.group(3)
+    try:
+        if operator == ":" and ".." in value:
+            low, _, high = value.partition("..")
+            return Range(field, range_value(field, low), range_value(field, high))
+        value = range_value(field, value)
+    except ValueError:
+        return None
+    if value is None:
+        return None
+    match operator:
+        case ":":
+            return Range(field, value, value)
+        case ">=":
+            return Range(field, value, None)
+        case ">":
+            return Range(field, value + 1, None)
+        case "<=":
+            return Range(field, None, value)
+        case "<":
+            return Range(field, None, value - 1)
+
+
+def clamp_value(value):
+    return None if value is None else min(max(value, RANGE_MIN), RANGE_MAX)
+
+
+class Range:
+    def __init__(self, field: str, low, high):
+        self.index = RANGE_FIELDS[field]
+        self.low = clamp_value(low)
+        self.high = clamp_value(high)
+
+    def key(self):
+        return "range", self.index, self.low, self.high
+
+    def estimate(self, database) -> int:
+        return getattr(database, self.index).count(self.low, self.high)
+
+    def evaluate(self, database, within):
+        output = getattr(database, self.index).range(self.low, self.high)
+        return output if within is None else output & within
+
+    def sql(self, database):
+        return database.range_sql(self.index, self.low, self.high)
+
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+    def key(self):
+        return "not", self.child.key()
+
+    def estimate(self, database) -> int:
+        return database.entry_count - self.child.estimate(database)
+
+    def evaluate(self, database, within):
+        base = database.ids if within is None else within
+        return base - self.child.evaluate(database, base)
+
+    def sql(self, database):
+        condition, params = self.child.sql(database)
+        return "NOT " + condition, params
+
+
+class Or:
+    def __init__(self, children: list):
+        self.children = children
+
+    def key(self):
+        return "or", frozenset(c.key() for c in self.children)
+
+    def estimate(self, database) -> int:
+        return min(database.entry_count, sum(c.estimate(database) for c in self.children))
+
+    def evaluate(self, database, within):
+        output = util.Bitmap()
+        for child in self.children:
+            output = output | child.evaluate(database, within)
+        return output
+
+    def sql(self, database):
+        conditions = [c.sql(database) for c in self.children]
+        return "(" + " OR ".join(c for c, _ in conditions) + ")", [p for _, params in conditions for p in params]
+
+
+class And:
+    def __init__(self, children: list):
+        self.children = children
+
+    def key(self):
+        return "and", frozenset(c.key() for c in self.children)
+
+    def estimate(self, database) -> int:
+        positives = [c.estimate(database) for c in self.children if not isinstance(c, Not)]
+        return min(positives) if len(positives) > 0 else database.entry_count
+
+    # Most selective lookups first, exclusions last, stopping once empty
+    def evaluate(self, database, within):
+        positives = [c for c in self.children if not isinstance(c, Not)]
+        negatives = [c for c in self.children if isinstance(c, Not)]
+        positives.sort(key=lambda c: c.estimate(database))
+
+        output = within
+        for child in positives + negatives:
+            output = child.evaluate(database, output)
+            if not output:
+                return util.Bitmap()
+        return database.ids.copy() if output is None else output
+
+    def sql(self, database):
+        conditions = [c.sql(database) for c in self.children]
+        return "(" + " AND ".join(c for c, _ in conditions) + ")", [p for _, params in conditions for p in params]
+
+
+#
+# Parser
+#
+class Parser:
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse_sequence(self) -> list:
+        nodes = []
+        while self.peek() not in (None, "close"):
+            if self.peek() == "bar":
+                self.next()
+                continue
+            node = self.parse_or()
+            if node is not None:
+                nodes.append(node)
+        return nodes
+
+    def parse_or(self):
+        children = [self.parse_unary()]
+        while self.peek() == "bar":
+            self.next()
+            if self.peek() in (None, "close"):
+                break
+            children.append(self.parse_unary())
+        children = [c for c in children if c is not None]
+        if len(children) == 1:
+            return children[0]
+        return Or(children) if len(children) > 0 else None
+
+    def parse_unary(self):
+        kind, value = self.next()
+        if kind in ("phrase", "facet") and value.strip() == "":
+            return None
+        if kind == "not":
+            if self.peek() in (None, "close", "bar"):
+                return None
+            child = self.parse_unary()
+            return Not(child) if child is not None else None
+        if kind == "open":
+            children = self.parse_sequence()
+            if self.peek() == "close":
+                self.next()
+            return And(children) if len(children) > 0 else None
+        if kind == "close":
+            return None
+        if kind == "field":
+            if self.peek() not in ("word", "phrase", "facet"):
+                return Text(value + ":", False)
+            field_value = self.next()[1]
+            if field_value.strip() == "":
+                return None
+            return Path(field_value) if value.lower() == "path" else Field(value, field_value)
+        if kind == "range":
+            node = parse_range(value)
+            return node if node is not None else Text(value, False)
+        if kind == "facet":
+            return Facet(value)
+        if kind == "phrase":
+            return Text(value, True)
+        return Text(value, False)
+
+
+#
+# Compiled Query
+#
+# Top level words and phrases only score entries. Everything else is
+# a constraint that the results must satisfy.
+#
+class Query:
+    def __init__(self, text: str):
+        parser = Parser(lex(text))
+        nodes = []
+        while parser.peek() is not None:
+            nodes.extend(parser.parse_sequence())
+            if parser.peek() == "close":
+                parser.next()
+
+        self.phrases = []
+        self.words = []
+        constraints = []
+        words = []
+        for node in nodes:
+            if isinstance(node, Text) and not node.quoted:
+                words.append(node.text)
+                self.words.append(node.text)
+                continue
+            if len(words) > 0:
+                self.phrases.append(words)
+                words = []
+            if isinstance(node, Text):
+                self.phrases.append([node.text])
+            else:
+                constraints.append(node)
+        if len(words) > 0:
+            self.phrases.append(words)
+
+        self.constraint = And(constraints) if len(constraints) > 0 else None
+
+    # Scores add up, so the order of the words and phrases doesn't matter
+    def key(self):
+        return (tuple(sorted(tuple(p) for p in self.phrases)), tuple(sorted(self.words)),
+                None if self.constraint is None else self.constraint.key())
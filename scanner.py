@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import time
+
+MANIFEST_VERSION = 4
+MANIFEST_FORMAT = b"APPL scan " + str(MANIFEST_VERSION).encode()
+MANIFEST_SUFFIX = ".scan"
+FINGERPRINT_SPAN = 64 * 1024
+MTIME_GRANULARITY = 2 * 10 ** 9  # FAT and SMB mtimes are only kept to a second or two
+
+#
+#
+# Scan Manifest
+#
+# What every file below the collection directory looked like when it was
+# last scanned, as (size, mtime_ns, inode), and the listing of every
+# directory with its mtime. A directory whose mtime hasn't changed still
+# holds the same names, so it isn't listed again, and only the files whose
+# size, mtime or inode changed need to be read again. A file added in the
+# same tick as the scan wouldn't change the mtime it recorded, so
+# directories modified within MTIME_GRANULARITY of the scan are recorded
+# without one, and listed again the next time.
+#
+# The first file of every entry also has a fingerprint of its contents,
+# so an entry whose file was moved or renamed can be found again.
+#
+# Paths are relative to the collection directory, and directories end in
+# "/", the root being "".
+#
+# Saved as a line naming the format, a line of JSON holding the collection
+# directory, which is checked before anything else is read, and a line of
+# JSON holding the tables.
+#
+class ScanManifest:
+    def __init__(self, db_dir: str):
+        self.db_dir = db_dir
+        self.files = dict()  # File -> (size, mtime_ns, inode)
+        self.directories = dict()  # Directory -> (mtime_ns or None, file names, directory names)
+        self.fingerprints = dict()  # First file of an entry -> fingerprint
+        self.by_fingerprint = None
+
+    # Files by fingerprint, made once it's first needed
+    def fingerprint_files(self) -> dict:
+        if self.by_fingerprint is None:
+            self.by_fingerprint = dict()
+            for file, fingerprint in self.fingerprints.items():
+                self.by_fingerprint.setdefault(fingerprint, []).append(file)
+        return self.by_fingerprint
+
+    def save(self, filepath: str):
+        fingerprints = {f: None if fingerprint is None else (fingerprint[0], fingerprint[1].hex())
+                        for f, fingerprint in self.fingerprints.items() if f in self.files}
+        tables = {"files": self.files, "directories": self.directories, "fingerprints": fingerprints}
+        try:
+            with open(filepath + ".tmp", "wb") as file:
+                file.write(MANIFEST_FORMAT + b"\n")
+                file.write(json.dumps(self.db_dir, ensure_ascii=False).encode("utf-8") + b"\n")
+                file.write(json.dumps(tables, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+            os.replace(filepath + ".tmp", filepath)
+        except OSError as e:
+            print("Scan manifest not saved:", e)
+
+
+# An empty manifest when there is none, or it was made for another directory
+def load_manifest(filepath: str, db_dir: str) -> ScanManifest:
+    manifest = ScanManifest(db_dir)
+    if not os.path.exists(filepath):
+        return manifest
+    try:
+        with open(filepath, "rb") as file:
+            if file.readline() != MANIFEST_FORMAT + b"\n" or json.loads(file.readline()) != db_dir:
+                return manifest
+            tables = json.loads(file.readline())
+        files = {f: tuple(state) for f, state in tables["files"].items()}
+        directories = {d: (mtime, names, folders) for d, (mtime, names, folders) in tables["directories"].items()}
+        fingerprints = {f: None if fingerprint is None else (fingerprint[0], bytes.fromhex(fingerprint[1]))
+                        for f, fingerprint in tables["fingerprints"].items()}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("Scan manifest not loaded:", e)
+        return manifest
+    manifest.files, manifest.directories, manifest.fingerprints = files, directories, fingerprints
+    return manifest
+
+
+# The collection directory, ending in a separator
+def base_dir(db_dir: str) -> str:
+    return db_dir if db_dir.endswith("/") or db_dir.endswith("\\") else db_dir + "/"
+
+
+def file_state(stat) -> tuple:
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def stat_file(path: str):
+    try:
+        return file_state(os.stat(path))
+    except OSError:
+        try:
+            return file_state(os.lstat(path))  # Broken links are still listed, as by os.walk
+        except OSError:
+            return None
+
+
+# Size and a hash of the first and last FINGERPRINT_SPAN bytes, which
+# changes with the contents but not with the path. Empty files have none,
+# as they can't be told apart.
+def fingerprint(path: str):
+    try:
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size <= 0:
+                return None
+            digest = hashlib.blake2b(file.read(FINGERPRINT_SPAN), digest_size=16)
+            if size > FINGERPRINT_SPAN:
+                file.seek(max(FINGERPRINT_SPAN, size - FINGERPRINT_SPAN))
+                digest.update(file.read(FINGERPRINT_SPAN))
+    except OSError:
+        return None
+    return size, digest.digest()
+
+
+# Names of the files and directories in a directory, and the state of the
+# files, leaving out the ignored ones. Links to directories aren't
+# followed, as by os.walk.
+def list_directory(path: str, ignored):
+    names, folders, states = [], [], []
+    with os.scandir(path) as iterator:
+        for entry in iterator:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink() and not ignored(entry.name + "/"):
+                    folders.append(entry.name)
+                continue
+            if ignored(entry.name):
+                continue
+            try:
+                state = file_state(entry.stat())
+            except OSError:
+                state = stat_file(entry.path)
+            names.append(entry.name)
+            states.append(state)
+    return names, folders, states
+
+
+# Every file below the collection directory, in os.walk order, yielded as
+# soon as its directory is listed and recorded with its directories in the
+# new manifest. Paths for which ignored() is true, with a trailing "/" for
+# directories, aren't yielded, recorded or walked into. Only the files below
+# the folder are scanned when one is given.
+def scan(old: ScanManifest, new: ScanManifest, ignored=lambda path: False, folder: str = ""):
+    base = base_dir(new.db_dir)
+    recent = time.time_ns() - MTIME_GRANULARITY
+    stack = [folder]
+    while len(stack) > 0:
+        folder = stack.pop()
+        path = base + folder
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+
+        listing = old.directories.get(folder)
+        if listing is not None and listing[0] == mtime:
+            names, folders = listing[1], listing[2]
+            states = (stat_file(path + name) for name in names)
+        else:
+            try:
+                names, folders, states = list_directory(path, lambda name: ignored(path + name))
+            except OSError:
+                continue
+        new.directories[folder] = (mtime if mtime < recent else None, names, folders)
+        stack.extend(folder + f + "/" for f in reversed(folders))
+
+        for name, state in zip(names, states):
+            if state is None:
+                continue
+            new.files[folder + name] = state
+            yield folder + name
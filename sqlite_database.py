@@ -0,0 +1,557 @@
+import array
+import io
+import json
+import os
+import sqlite3
+
+import database as db
+import query as q
+import util
+
+PAGE_SIZE = 256
+FACET_COLUMNS = {
+    "authors": "author_key",
+    "series": "series_key",
+    "languages": "language_key",
+    "age_ratings": "age_rating_key",
+    "extensions": "extension",
+}
+LABEL_COLUMNS = {
+    "authors": "author",
+    "series": "series",
+    "languages": "language",
+    "age_ratings": "age_rating",
+    "extensions": "extension",
+}
+ENTRY_COLUMNS = "id, path, cover_path, name, author, series, vol, language, age_rating, release, width, height"
+
+#
+#
+# SQLite Database
+#
+# Keeps the entries on disk rather than in dictionaries, for libraries
+# too large to hold in memory. Opened for files ending in .sqlite, with
+# the same methods as Database.
+#
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    cover_path TEXT,
+    name TEXT,
+    author TEXT,
+    series TEXT,
+    vol INTEGER,
+    language TEXT,
+    age_rating TEXT,
+    release INTEGER,
+    width INTEGER,
+    height INTEGER,
+    name_key TEXT,
+    path_key TEXT,
+    author_key TEXT,
+    series_key TEXT,
+    language_key TEXT,
+    age_rating_key TEXT,
+    extension TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (
+    entry INTEGER NOT NULL REFERENCES entries(id) ON DELETE CASCADE,
+    position INTEGER,
+    tag TEXT,
+    tag_key TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_author ON entries(author_key);
+CREATE INDEX IF NOT EXISTS entries_series ON entries(series_key);
+CREATE INDEX IF NOT EXISTS entries_language ON entries(language_key);
+CREATE INDEX IF NOT EXISTS entries_age_rating ON entries(age_rating_key);
+CREATE INDEX IF NOT EXISTS entries_extension ON entries(extension);
+CREATE INDEX IF NOT EXISTS entries_release ON entries(release);
+CREATE INDEX IF NOT EXISTS entries_vol ON entries(vol);
+CREATE INDEX IF NOT EXISTS entries_pixels ON entries(width * height);
+CREATE INDEX IF NOT EXISTS tags_key ON tags(tag_key, entry);
+CREATE INDEX IF NOT EXISTS tags_entry ON tags(entry, position);
+"""
+
+# Trigram full text search over names and paths, kept in step with entries
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    name_key, path_key, content='entries', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS entries_fts_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts(rowid, name_key, path_key) VALUES (new.id, new.name_key, new.path_key);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_fts_delete AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts(entries_fts, rowid, name_key, path_key) VALUES ('delete', old.id, old.name_key, old.path_key);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_fts_update AFTER UPDATE OF name_key, path_key ON entries BEGIN
+    INSERT INTO entries_fts(entries_fts, rowid, name_key, path_key) VALUES ('delete', old.id, old.name_key, old.path_key);
+    INSERT INTO entries_fts(rowid, name_key, path_key) VALUES (new.id, new.name_key, new.path_key);
+END;
+"""
+
+
+def extension_key(path: str) -> str:
+    return util.normalize(path[path.rfind(".")+1:]) if "." in path else ""
+
+
+def entry_row(entry: db.Entry) -> tuple:
+    return (entry.path, entry.cover_path, entry.name, entry.author, entry.series, entry.vol,
+            entry.language, entry.age_rating, entry.release, entry.resolution[0], entry.resolution[1],
+            entry.name_key, entry.path_key, util.normalize(entry.author), util.normalize(entry.series),
+            util.normalize(entry.language), util.normalize(entry.age_rating), extension_key(entry.path))
+
+
+# Entries are read a page at a time, in id order
+class EntryTable:
+    def __init__(self, database):
+        self.database = database
+
+    def __len__(self):
+        return self.database.entry_count
+
+    def __iter__(self):
+        last = -1
+        while True:
+            ids = [r[0] for r in self.database.connection.execute(
+                "SELECT id FROM entries WHERE id > ? ORDER BY id LIMIT ?", (last, PAGE_SIZE))]
+            if len(ids) <= 0:
+                return
+            yield from self.database.entries_by_ids(ids)
+            last = ids[-1]
+
+    def __getitem__(self, i: int) -> db.Entry:
+        row = self.database.connection.execute(
+            "SELECT id FROM entries ORDER BY id LIMIT 1 OFFSET ?", (i if i >= 0 else len(self) + i,)).fetchone()
+        if row is None:
+            raise IndexError(i)
+        return self.database.entries_by_ids([row[0]])[0]
+
+
+class PathTable:
+    def __init__(self, database):
+        self.database = database
+
+    def __contains__(self, path: str) -> bool:
+        return self.database.connection.execute("SELECT 1 FROM entries WHERE path = ?", (path,)).fetchone() is not None
+
+    def __getitem__(self, path: str) -> db.Entry:
+        row = self.database.connection.execute("SELECT id FROM entries WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            raise KeyError(path)
+        return self.database.entries_by_ids([row[0]])[0]
+
+
+class SQLiteDatabase:
+    def __init__(self, directory):
+        self.file_dir = directory
+        self.connection = sqlite3.connect(directory)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+        try:
+            self.connection.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False  # Built without FTS5, so names and paths are scanned
+
+        meta = dict(self.connection.execute("SELECT key, value FROM meta"))
+        self.name = meta.get("name", os.path.basename(directory)[:-len(db.SQLITE_SUFFIX)])
+        self.db_dir = meta.get("db_dir", os.path.dirname(os.path.abspath(directory)).replace("\\", "/") + "/")
+        self.app_associations = json.loads(meta.get("app_associations", "{}"))
+        self.entry_count = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+        self.entries = EntryTable(self)
+        self.filepaths = PathTable(self)
+        self.fuzzy_search = False
+        self.loading_total = 0
+        self.loading_current = 0
+
+        self.generation = 0
+        self.query_cache = util.LRUCache(db.QUERY_CACHE_SIZE, db.QUERY_CACHE_IDS)
+
+    # Shared with the in-memory database
+    ignored_files = db.Database.ignored_files
+    clean_entries = db.Database.clean_entries
+    import_files = db.Database.import_files
+    load_files = db.Database.load_files
+    update_files = db.Database.update_files
+    moved_entry = db.Database.moved_entry
+    entry_file = db.Database.entry_file
+    appl_records = db.Database.appl_records
+
+    def entries_by_ids(self, ids: list) -> list:
+        marks = ", ".join("?" * len(ids))
+        rows = {r[0]: r for r in self.connection.execute(
+            "SELECT " + ENTRY_COLUMNS + " FROM entries WHERE id IN (" + marks + ")", ids)}
+        tags = dict()
+        for entry, tag in self.connection.execute(
+                "SELECT entry, tag FROM tags WHERE entry IN (" + marks + ") ORDER BY entry, position", ids):
+            util.dictionary_list_add(tags, entry, tag)
+
+        output = []
+        for i in ids:
+            if i not in rows:
+                continue
+            _, path, cover, name, author, series, vol, language, age_rating, release, width, height = rows[i]
+            entry = db.Entry(path, cover, name, author, series, vol, language, age_rating, release,
+                             (width, height), tags.get(i, []))
+            entry.id = i
+            output.append(entry)
+        return output
+
+    # Import / Export
+    def import_entries(self, entries):
+        for entry in entries:
+            self.insert_entry(entry)
+        self.entry_count = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        self.generation += 1
+        self.connection.commit()
+
+    # Streams the records of an APPL file into the database
+    def import_appl(self, filepath: str):
+        with open(filepath, "rb") as raw, io.TextIOWrapper(db.open_compressed(raw, filepath, "rb"),
+                                                            encoding="utf-8") as file:
+            records = db.read_appl(file)
+            name, db_dir, app_associations, _ = db.parse_header(next(records))
+            self.set_preferences(name, app_associations)
+            self.set_db_dir(db_dir)
+            self.import_entries(db.parse_entry(lines) for lines in records)
+
+    def set_db_dir(self, db_dir: str):
+        self.db_dir = db_dir
+        self.set_meta("db_dir", db_dir)
+
+    def save_as_file(self, filepath: str):
+        self.connection.commit()
+        if filepath.endswith(db.SQLITE_SUFFIX):
+            target = sqlite3.connect(filepath)
+            self.connection.backup(target)
+            target.close()
+            return
+        db.write_appl(filepath, self.appl_records())
+
+    # Journal
+    # SQLite keeps its own, so syncing is a commit
+    def sync_journal(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def build_text_index(self, budget: float = None) -> bool:
+        return True
+
+    def set_meta(self, key: str, value: str):
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def set_app_associations(self, extension: str, app: str):
+        self.app_associations[extension] = app
+        self.set_meta("app_associations", json.dumps(self.app_associations))
+
+    def set_preferences(self, name: str, app_associations: dict):
+        self.name = name
+        self.app_associations = app_associations
+        self.set_meta("name", name)
+        self.set_meta("app_associations", json.dumps(app_associations))
+
+    # Entries
+    def insert_entry(self, entry: db.Entry):
+        cursor = self.connection.execute(
+            "INSERT INTO entries (path, cover_path, name, author, series, vol, language, age_rating, release, "
+            "width, height, name_key, path_key, author_key, series_key, language_key, age_rating_key, extension) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", entry_row(entry))
+        self.connection.executemany(
+            "INSERT INTO tags (entry, position, tag, tag_key) VALUES (?, ?, ?, ?)",
+            [(cursor.lastrowid, i, t, util.normalize(t)) for i, t in enumerate(entry.tags)])
+        return cursor.lastrowid
+
+    def add_entry(self, entry: db.Entry):
+        self.generation += 1
+        entry.id = self.insert_entry(entry)
+        self.entry_count += 1
+
+    # Each batch of an import is committed together
+    def add_entries(self, entries: list):
+        for entry in entries:
+            self.add_entry(entry)
+        self.connection.commit()
+
+    def remove_entry(self, entry: db.Entry):
+        self.remove_entries([entry.id])
+
+    def remove_entries(self, ids):
+        self.generation += 1
+        self.connection.executemany("DELETE FROM entries WHERE id = ?", [(i,) for i in ids])
+        self.entry_count = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def update(self, entry: db.Entry, **columns):
+        self.generation += 1
+        self.connection.execute("UPDATE entries SET " + ", ".join(c + " = ?" for c in columns) + " WHERE id = ?",
+                                (*columns.values(), entry.id))
+
+    def move_entry(self, entry: db.Entry, path: str):
+        old_file = self.db_dir + entry.path
+        if entry.cover_path == old_file or entry.cover_path.startswith(old_file + "/"):
+            entry.cover_path = self.db_dir + path + entry.cover_path[len(old_file):]
+        entry.path = path
+        entry.update_keys()
+        self.update(entry, path=path, path_key=entry.path_key, cover_path=entry.cover_path,
+                    extension=extension_key(path))
+
+    def set_cover(self, entry: db.Entry, cover: str):
+        entry.cover_path = cover
+        self.update(entry, cover_path=cover)
+
+    def set_name(self, entry: db.Entry, name: str):
+        entry.name = name
+        entry.update_keys()
+        self.update(entry, name=name, name_key=entry.name_key)
+
+    def set_author(self, entry: db.Entry, author: str):
+        entry.author = author
+        self.update(entry, author=author, author_key=util.normalize(author))
+
+    def set_series(self, entry: db.Entry, series: str):
+        entry.series = series
+        self.update(entry, series=series, series_key=util.normalize(series))
+
+    def set_vol(self, entry: db.Entry, vol: int):
+        entry.vol = vol
+        self.update(entry, vol=vol)
+
+    def set_language(self, entry: db.Entry, language: str):
+        entry.language = language
+        self.update(entry, language=language, language_key=util.normalize(language))
+
+    def set_rating(self, entry: db.Entry, age_rating: str):
+        entry.age_rating = age_rating
+        self.update(entry, age_rating=age_rating, age_rating_key=util.normalize(age_rating))
+
+    def set_release(self, entry: db.Entry, release: int):
+        entry.release = release
+        self.update(entry, release=release)
+
+    def set_resolution(self, entry: db.Entry, x: int, y: int):
+        entry.resolution = (x, y)
+        self.update(entry, width=x, height=y)
+
+    def write_tags(self, entry: db.Entry):
+        self.generation += 1
+        self.connection.execute("DELETE FROM tags WHERE entry = ?", (entry.id,))
+        self.connection.executemany(
+            "INSERT INTO tags (entry, position, tag, tag_key) VALUES (?, ?, ?, ?)",
+            [(entry.id, i, t, util.normalize(t)) for i, t in enumerate(entry.tags)])
+
+    def add_tag(self, entry: db.Entry, tag: str):
+        entry.tags.append(tag)
+        self.write_tags(entry)
+
+    def remove_tag(self, entry: db.Entry, tag: str):
+        entry.tags.remove(tag)
+        self.write_tags(entry)
+
+    def set_tags(self, entry: db.Entry, tags: str):
+        entry.tags = [t.strip() for t in tags.split(",")]
+        self.write_tags(entry)
+
+    # Facet values, as used by the filter dialog
+    def facet_values(self, facet: str) -> dict:
+        if facet == "tags":
+            rows = self.connection.execute("SELECT tag_key, COUNT(DISTINCT entry) FROM tags GROUP BY tag_key")
+        else:
+            column = FACET_COLUMNS[facet]
+            rows = self.connection.execute("SELECT " + column + ", COUNT(*) FROM entries GROUP BY " + column)
+        return dict(rows)
+
+    # (value, label, entries), most common first, as Database.facet_counts
+    def facet_counts(self, facet: str, query: str = "") -> list:
+        query = " ".join(query.split())
+        condition, params = ("1", []) if query == "" else self.query_sql(q.Query(query))[2:]
+        if facet == "tags":
+            rows = self.connection.execute(
+                "SELECT tag_key, MIN(tag), COUNT(DISTINCT entry) FROM tags WHERE entry IN (SELECT id FROM entries WHERE "
+                + condition + ") GROUP BY tag_key", params)
+        else:
+            column = FACET_COLUMNS[facet]
+            rows = self.connection.execute(
+                "SELECT " + column + ", MIN(" + LABEL_COLUMNS[facet] + "), COUNT(*) FROM entries WHERE " + condition
+                + " GROUP BY " + column, params)
+        output = [r for r in rows if not (facet == "extensions" and r[0] == "")]
+        output.sort(key=lambda v: (-v[2], v[0]))
+        return output
+
+    @property
+    def tags(self) -> dict:
+        return self.facet_values("tags")
+
+    @property
+    def authors(self) -> dict:
+        return self.facet_values("authors")
+
+    @property
+    def series(self) -> dict:
+        return self.facet_values("series")
+
+    @property
+    def languages(self) -> dict:
+        return self.facet_values("languages")
+
+    @property
+    def age_ratings(self) -> dict:
+        return self.facet_values("age_ratings")
+
+    @property
+    def extensions(self) -> dict:
+        return self.facet_values("extensions")
+
+    # SQL Conditions
+    # Built by the query plan nodes in place of evaluating bitmaps
+    def facet_sql(self, value: str):
+        columns = " OR ".join(c + " = ?" for c in FACET_COLUMNS.values())
+        return ("(" + columns + " OR id IN (SELECT entry FROM tags WHERE tag_key = ?))",
+                [value] * (len(FACET_COLUMNS) + 1))
+
+    def field_sql(self, facet: str, value: str):
+        if facet == "tags":
+            exact = self.connection.execute("SELECT 1 FROM tags WHERE tag_key = ?", (value,)).fetchone()
+            condition = "tag_key = ?" if exact is not None else "instr(tag_key, ?) > 0"
+            return "id IN (SELECT entry FROM tags WHERE " + condition + ")", [value]
+        column = FACET_COLUMNS[facet]
+        exact = self.connection.execute("SELECT 1 FROM entries WHERE " + column + " = ?", (value,)).fetchone()
+        return (column + " = ?" if exact is not None else "instr(" + column + ", ?) > 0"), [value]
+
+    def text_sql(self, text: str):
+        facets, params = self.facet_sql(text)
+        if self.fts and len(text) >= 3:
+            return ("(" + facets + " OR id IN (SELECT rowid FROM entries_fts WHERE entries_fts MATCH ?))",
+                    params + ['"' + text.replace('"', '""') + '"'])
+        return "(" + facets + " OR instr(name_key, ?) > 0 OR instr(path_key, ?) > 0)", params + [text, text]
+
+    def range_sql(self, index: str, low, high):
+        column = {"releases": "release", "vols": "vol", "resolutions": "width * height"}[index]
+        conditions, params = [], []
+        if low is not None:
+            conditions.append(column + " >= ?")
+            params.append(low)
+        if high is not None:
+            conditions.append(column + " <= ?")
+            params.append(high)
+        return ("(" + " AND ".join(conditions) + ")" if len(conditions) > 0 else "1"), params
+
+    # Folders
+    # The paths below a folder sort together, between "folder/" and
+    # "folder0", so they're a range of the path index
+    def path_sql(self, folder: str):
+        folder = folder.strip("/")
+        if folder == "":
+            return "1", []
+        return "(path = ? OR (path >= ? AND path < ?))", [folder, folder + "/", folder + "0"]
+
+    def folder_ids(self, folder: str) -> list:
+        condition, params = self.path_sql(folder)
+        return [r[0] for r in self.connection.execute("SELECT id FROM entries WHERE " + condition + " ORDER BY path", params)]
+
+    def folder_entries(self, folder: str):
+        return self.pages(self.folder_ids(folder))
+
+    def folder_count(self, folder: str) -> int:
+        condition, params = self.path_sql(folder)
+        return self.connection.execute("SELECT count(*) FROM entries WHERE " + condition, params).fetchone()[0]
+
+    def browse(self, folder: str):
+        folder = folder.strip("/")
+        condition, params = self.path_sql(folder)
+        folders = dict()
+        ids = []
+        start = len(folder) + 1 if folder != "" else 0
+        for entry_id, path, extension in self.connection.execute(
+                "SELECT id, path, extension FROM entries WHERE " + condition + " ORDER BY path", params):
+            if path == folder:
+                continue
+            name, separator, _ = path[start:].lstrip("/").partition("/")
+            if separator == "":
+                ids.append(entry_id)
+                continue
+            count, kinds = folders.get(name, (0, dict()))
+            kinds[extension] = kinds.get(extension, 0) + 1
+            folders[name] = (count + 1, kinds)
+        return [(name, count, kinds) for name, (count, kinds) in folders.items()], list(self.pages(ids))
+
+    # Search
+    # Scored like Database.score_phrases: a point for a facet value equal
+    # to each contiguous phrase, and one each for a name and path holding it
+    # (score, params, condition, params) selecting and scoring the results
+    def query_sql(self, plan: q.Query) -> tuple:
+        scores, score_params = [], []
+        candidates, candidate_params = [], []
+        for words in plan.phrases:
+            for i in range(len(words)):
+                for j in range(i, len(words)):
+                    phrase = " ".join(words[i:j+1])
+                    facets, params = self.facet_sql(phrase)
+                    scores.append("(" + facets + ") + (instr(name_key, ?) > 0) + (instr(path_key, ?) > 0)")
+                    score_params.extend(params + [phrase, phrase])
+                    condition, params = self.text_sql(phrase)
+                    candidates.append(condition)
+                    candidate_params.extend(params)
+
+        if plan.constraint is not None:
+            condition, params = plan.constraint.sql(self)
+        elif len(candidates) > 0:
+            condition, params = " OR ".join(candidates), candidate_params
+        else:
+            condition, params = "0", []
+        score = " + ".join(scores) if len(scores) > 0 else "0"
+        return score, score_params, condition, params
+
+    def query_ranked(self, text: str) -> list:
+        plan = q.Query(text)
+        ranked = self.query_cache.get(("query", plan.key()), self.generation)
+        if ranked is not None:
+            return ranked
+
+        score, score_params, condition, params = self.query_sql(plan)
+        ranked = array.array("q", (r[0] for r in self.connection.execute(
+            "SELECT id, " + score + " AS score FROM entries WHERE " + condition + " ORDER BY score DESC, id",
+            score_params + params)))
+        self.query_cache.put(("query", plan.key()), ranked, self.generation, len(ranked))
+        return ranked
+
+    def pages(self, ids: list):
+        for start in range(0, len(ids), PAGE_SIZE):
+            yield from self.entries_by_ids(ids[start:start+PAGE_SIZE])
+
+    def query(self, text: str) -> list:
+        return list(self.pages(self.query_ranked(" ".join(text.split()))))
+
+    def query_cursor(self, text: str) -> db.ResultCursor:
+        ranked = self.query_ranked(" ".join(text.split()))
+        return db.ResultCursor(self.pages(ranked), len(ranked))
+
+    def top(self, text: str, count: int) -> list:
+        return self.query_cursor(text).fetch(count)
+
+    def search(self, query: str) -> list:
+        return self.query(query)
+
+    def cache_stats(self) -> dict:
+        return self.query_cache.stats()
+
+
+# Replaces the file with a SQLite database holding the entries of another
+def write_sqlite(filepath: str, source):
+    for path in (filepath, filepath + "-wal", filepath + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    target = SQLiteDatabase(filepath)
+    target.set_preferences(source.name, dict(source.app_associations))
+    target.set_db_dir(source.db_dir)
+    target.import_entries(source.entries)
+    target.close()
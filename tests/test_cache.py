@@ -0,0 +1,22 @@
+import util
+
+
+def test_cache_keeps_within_its_budget():
+    cache = util.LRUCache(8, budget=10)
+    cache.put("a", "a", 0, 4)
+    cache.put("b", "b", 0, 4)
+    cache.put("c", "c", 0, 4)
+    assert cache.get("a", 0) is None
+    assert cache.get("b", 0) == "b" and cache.get("c", 0) == "c"
+    assert cache.total == 8
+
+
+def test_cache_skips_values_over_its_budget():
+    cache = util.LRUCache(8, budget=10)
+    cache.put("a", "a", 0, 4)
+    cache.put("big", "big", 0, 11)
+    assert cache.get("big", 0) is None
+    assert cache.get("a", 0) == "a"
+    cache.put("a", "a", 0, 6)
+    assert cache.total == 6
+    assert cache.get("a", 1) is None and cache.total == 0
@@ -0,0 +1,69 @@
+import os
+import shutil
+
+import database as db
+
+
+def write_appl(path, tags: str):
+    with open(path, "w") as file:
+        file.write("Lib\n/media/\n\n{'mp3': 'vlc'}\n1\n"
+                   "\n---\n\na.png\n\nA\n\n, 0\n, \n0\n1x1\n" + tags + "\n")
+
+
+def open_tags(appl) -> list:
+    database = db.Database(str(appl))
+    tags = database.filepaths["a.png"].tags
+    database.close()
+    return tags
+
+
+def edit(appl):
+    database = db.Database(str(appl))
+    entry = database.filepaths["a.png"]
+    database.add_tag(entry, "new")
+    database.remove_tag(entry, "foo")
+    database.sync_journal()
+    return database
+
+
+def test_journal_replayed_over_the_file(tmp_path):
+    appl = tmp_path / "lib.appl"
+    write_appl(appl, "foo, bar")
+    edit(appl).close()
+    assert open_tags(appl) == ["bar", "new"]
+
+
+# As when saving stops between writing the file and dropping the journal
+def test_journal_outliving_the_file_it_was_folded_into(tmp_path):
+    appl = tmp_path / "lib.appl"
+    write_appl(appl, "foo, bar")
+    database = edit(appl)
+    shutil.copy(database.journal_path, tmp_path / "kept")
+    database.save_as_file(str(appl))
+    shutil.copy(tmp_path / "kept", database.journal_path)
+    assert open_tags(appl) == ["bar", "new"]
+    os.remove(str(appl) + db.SNAPSHOT_SUFFIX)
+    assert open_tags(appl) == ["bar", "new"]
+
+
+def test_compacted_file_skips_the_journal_it_holds(tmp_path):
+    appl = tmp_path / "lib.appl"
+    write_appl(appl, "foo, bar")
+    database = edit(appl)
+    shutil.copy(database.journal_path, tmp_path / "kept")
+    database.compact()
+    database.wait_compaction()
+    database.close()
+    shutil.copy(tmp_path / "kept", database.journal_path + db.JOURNAL_OLD_SUFFIX)  # Left by a crash
+    assert open_tags(appl) == ["bar", "new"]
+    assert not os.path.exists(database.journal_path + db.JOURNAL_OLD_SUFFIX)
+
+
+# Journals from before ids, or files edited by hand, may not match
+def test_replay_tolerates_tags_already_changed(tmp_path):
+    appl = tmp_path / "lib.appl"
+    write_appl(appl, "bar, new")
+    with open(str(appl) + db.JOURNAL_SUFFIX, "w") as file:
+        file.write('["add_tag", "a.png", "new"]\n["remove_tag", "a.png", "foo"]\n')
+    assert open_tags(appl) == ["bar", "new"]
+    assert not os.path.exists(str(appl) + db.JOURNAL_SUFFIX)
@@ -0,0 +1,28 @@
+import query as q
+
+
+def key(text: str):
+    return q.Query(text).key()
+
+
+def test_unfinished_facet_shares_the_plan():
+    assert key("dragon [isek") == key("dragon")
+    assert key("dragon  ") == key("dragon")
+
+
+def test_constraint_order_and_spelling_share_the_plan():
+    assert key("[isekai] moon [fantasy]") == key("[Fantasy] [isekai] moon")
+    assert key("lang:english -[romance]") == key("-[Romance] language:English")
+    assert key("[a] OR [b]") == key("[b] | [a]")
+
+
+def test_different_plans_differ():
+    assert key("dragon magic") != key("magic dragon")
+    assert key('"dragon"') != key("dragon")
+    assert key("release:2010..2015") != key("release:2010..2016")
+    assert key("-[a]") != key("[a]")
+
+
+def test_stray_bracket_keeps_the_rest_of_the_query():
+    assert q.lex("dragon ] kings") == [("word", "dragon"), ("word", "kings")]
+    assert key("dragon ] kings") == key("dragon kings")
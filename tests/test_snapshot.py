@@ -0,0 +1,95 @@
+import os
+import pickle
+
+import database as db
+import scanner
+
+FIELDS = ("path", "cover_path", "name", "author", "series", "vol", "language", "age_rating", "release",
+          "resolution", "tags", "name_key", "path_key")
+
+
+def write_appl(path):
+    with open(path, "w") as file:
+        file.write("Lib\n/media/\n\n{'mp3': 'vlc'}\n3\n")
+        file.write("\n---\n\na.png\n\nÉtoile\nAuthor\nSeries, 2\nEnglish, PG\n2011\n4x3\nfoo, bar\n")
+        file.write("\n---\n\nb/c.mkv\n/cache/c.png\nC\nAuthor\n, 0\n, \n0\n0x0\n\n")
+        file.write("\n---\n\nd.epub\n\nD\nOther\nSeries, 1\nFrançais, R\n1999\n1x1\nbar\n")
+
+
+def rows(database) -> list:
+    return [[getattr(e, f) for f in FIELDS] for e in database.entries]
+
+
+# Unpickling this would leave a file behind
+class Planted:
+    def __init__(self, marker):
+        self.marker = str(marker)
+
+    def __reduce__(self):
+        return open, (self.marker, "w")
+
+
+def test_snapshot_loads_what_the_file_holds(tmp_path, monkeypatch):
+    appl = str(tmp_path / "lib.appl")
+    write_appl(appl)
+    text = db.Database(appl)
+    assert os.path.exists(appl + db.SNAPSHOT_SUFFIX)
+
+    monkeypatch.setattr(db.Database, "read_file", None)
+    snapshot = db.Database(appl)
+    assert rows(snapshot) == rows(text)
+    for name in db.FACETS:
+        assert {k: list(v) for k, v in getattr(snapshot, name).items()} == \
+               {k: list(v) for k, v in getattr(text, name).items()}
+    assert snapshot.value_counts == text.value_counts
+    assert snapshot.value_labels == text.value_labels
+    for name in db.SNAPSHOT_RANGES:
+        assert getattr(snapshot, name).pairs == getattr(text, name).pairs
+
+
+def test_snapshot_of_another_file_is_ignored(tmp_path):
+    appl = str(tmp_path / "lib.appl")
+    write_appl(appl)
+    db.Database(appl)
+    with open(appl, "a") as file:
+        file.write("\n---\n\ne.png\n\nE\n\n, 0\n, \n0\n1x1\n\n")
+    assert len(db.Database(appl).entries) == 4
+
+
+def test_planted_pickles_are_not_loaded(tmp_path):
+    appl = str(tmp_path / "lib.appl")
+    write_appl(appl)
+    marker = tmp_path / "unpickled"
+    for suffix in (db.SNAPSHOT_SUFFIX, scanner.MANIFEST_SUFFIX):
+        with open(appl + suffix, "wb") as file:
+            pickle.dump(Planted(marker), file)
+    database = db.Database(appl)
+    manifest = scanner.load_manifest(appl + scanner.MANIFEST_SUFFIX, database.db_dir)
+    assert not marker.exists()
+    assert len(database.entries) == 3
+    assert len(manifest.files) == 0
+
+
+def test_manifest_round_trip(tmp_path):
+    manifest = scanner.ScanManifest("/media/")
+    manifest.files = {"a.png": (3, 10, 7), "b/c.mkv": (0, 11, 8)}
+    manifest.directories = {"": (1, ["a.png"], ["b"]), "b/": (2, ["c.mkv"], [])}
+    manifest.fingerprints = {"a.png": (3, b"\x00\xff"), "b/c.mkv": None, "gone.png": (1, b"")}
+    manifest.save(str(tmp_path / "lib.appl.scan"))
+
+    loaded = scanner.load_manifest(str(tmp_path / "lib.appl.scan"), "/media/")
+    assert loaded.files == manifest.files
+    assert loaded.directories == manifest.directories
+    assert loaded.fingerprints == {"a.png": (3, b"\x00\xff"), "b/c.mkv": None}
+    assert len(scanner.load_manifest(str(tmp_path / "lib.appl.scan"), "/elsewhere/").files) == 0
+
+
+# As on filesystems keeping mtimes to a second or two
+def test_file_added_in_the_same_tick_is_found(tmp_path):
+    (tmp_path / "a.png").write_text("a")
+    mtime = os.stat(tmp_path).st_mtime_ns
+    old = scanner.ScanManifest(str(tmp_path) + "/")
+    assert list(scanner.scan(scanner.ScanManifest(old.db_dir), old)) == ["a.png"]
+    (tmp_path / "b.png").write_text("b")
+    os.utime(tmp_path, ns=(mtime, mtime))
+    assert sorted(scanner.scan(old, scanner.ScanManifest(old.db_dir))) == ["a.png", "b.png"]
@@ -0,0 +1,233 @@
+import os
+import shutil
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+import database as db
+import watcher
+
+
+def write_image(path, width: int, height: int):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cv2.imwrite(str(path), np.zeros((height, width, 3), np.uint8))
+
+
+def write_text(path, text: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(text)
+
+
+# A small collection: loose files, a folder of frames and a nested folder
+@pytest.fixture
+def library(tmp_path):
+    root = tmp_path / "lib"
+    write_image(root / "a" / "one.png", 4, 3)
+    write_text(root / "a" / "two.txt", "two")
+    write_image(root / "b" / "anim" / "0000.png", 5, 5)
+    write_image(root / "b" / "anim" / "0001.png", 5, 5)
+    write_text(root / "c" / "d" / "three.txt", "three")
+    return root
+
+
+def open_library(root, appl):
+    with open(appl, "w") as file:
+        file.write("Lib\n" + str(root) + "/\n\n{'mp3': 'vlc'}\n0\n")
+    database = db.Database(str(appl))
+    database.load_files(None, None, 1)
+    return database
+
+
+def entry_paths(database) -> list:
+    return sorted(e.path for e in database.entries)
+
+
+# Waits for the watcher to notice changes, without waiting out the debounce
+def settle(w: watcher.Watcher, timeout: float = 5.0):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        time.sleep(0.05)
+        paths = w.changes(time.monotonic() + watcher.WATCH_DEBOUNCE)
+        if paths is None or len(paths) > 0:
+            return paths
+    return set()
+
+
+def wait_started(w: watcher.PollingWatcher):
+    end = time.monotonic() + 5.0
+    while w.manifest is None and time.monotonic() < end:
+        time.sleep(0.01)
+
+
+# Debouncing
+
+def test_changes_wait_until_quiet(tmp_path):
+    w = watcher.Watcher(str(tmp_path))
+    w.changed(["a", "b"])
+    w.changed(["a"])
+    assert w.changes(w.last_change + watcher.WATCH_DEBOUNCE / 2) == set()
+    assert w.changes(w.last_change + watcher.WATCH_DEBOUNCE) == {"a", "b"}
+    assert w.changes(w.last_change + watcher.WATCH_DEBOUNCE * 2) == set()
+
+
+def test_changes_handed_over_after_max_delay(tmp_path):
+    w = watcher.Watcher(str(tmp_path))
+    w.changed(["a"])
+    start = w.first_change
+    w.changed(["b"])
+    w.last_change = start + watcher.WATCH_MAX_DELAY - watcher.WATCH_DEBOUNCE / 2  # Still changing
+    assert w.changes(start + watcher.WATCH_MAX_DELAY - 0.01) == set()
+    assert w.changes(start + watcher.WATCH_MAX_DELAY) == {"a", "b"}
+
+
+def test_changes_skip_ignored_paths(tmp_path):
+    w = watcher.Watcher(str(tmp_path), lambda path: path.endswith(".tmp"))
+    w.changed(["a.png", "a.png.tmp"])
+    assert w.changes(w.last_change + watcher.WATCH_DEBOUNCE) == {"a.png"}
+
+
+def test_lost_changes_ask_for_rescan(tmp_path):
+    w = watcher.Watcher(str(tmp_path))
+    w.changed(["a"])
+    w.changed([], rescan=True)
+    assert w.changes(w.last_change + watcher.WATCH_DEBOUNCE) is None
+    assert w.changes(w.last_change + watcher.WATCH_DEBOUNCE) == set()
+
+
+# Polling
+
+def test_polling_finds_added_modified_and_deleted_files(library):
+    w = watcher.PollingWatcher(str(library) + "/", interval=0.05)
+    w.start()
+    try:
+        wait_started(w)
+        write_text(library / "a" / "new.txt", "new")
+        write_text(library / "a" / "two.txt", "two, longer")
+        os.remove(library / "c" / "d" / "three.txt")
+        assert settle(w) == {"a/new.txt", "a/two.txt", "c/d/three.txt"}
+    finally:
+        w.stop()
+
+
+def test_polling_skips_ignored_files(library):
+    w = watcher.PollingWatcher(str(library) + "/", lambda path: path.endswith(".journal"), interval=0.05)
+    w.start()
+    try:
+        wait_started(w)
+        write_text(library / "lib.appl.journal", "[]")
+        write_text(library / "a" / "new.txt", "new")
+        assert settle(w) == {"a/new.txt"}
+    finally:
+        w.stop()
+
+
+# Inotify
+
+inotify = pytest.mark.skipif(not watcher.inotify_available(), reason="inotify is Linux only")
+
+
+@inotify
+def test_inotify_finds_file_changes(library):
+    w = watcher.InotifyWatcher(str(library) + "/")
+    w.start()
+    try:
+        write_text(library / "a" / "new.txt", "new")
+        os.remove(library / "a" / "two.txt")
+        assert settle(w) == {"a/new.txt", "a/two.txt"}
+    finally:
+        w.stop()
+
+
+@inotify
+def test_inotify_follows_created_and_moved_directories(library, tmp_path):
+    w = watcher.InotifyWatcher(str(library) + "/")
+    w.start()
+    try:
+        os.makedirs(library / "e")
+        assert settle(w) == {"e"}
+        assert "e/" in w.folders.values()
+        write_text(library / "e" / "inside.txt", "inside")
+        assert settle(w) == {"e/inside.txt"}
+
+        shutil.move(str(library / "c"), str(tmp_path / "c"))
+        assert settle(w) == {"c"}
+        assert not any(folder.startswith("c/") for folder in w.folders.values())
+
+        shutil.move(str(tmp_path / "c"), str(library / "f"))
+        assert settle(w) == {"f"}
+        write_text(library / "f" / "d" / "four.txt", "four")
+        assert settle(w) == {"f/d/four.txt"}
+    finally:
+        w.stop()
+
+
+@inotify
+def test_inotify_overflow_asks_for_rescan(library, monkeypatch):
+    w = watcher.InotifyWatcher(str(library) + "/")
+    overflow = watcher.EVENT_HEADER.pack(-1, watcher.IN_Q_OVERFLOW, 0, 0)
+    monkeypatch.setattr(watcher.os, "read", lambda fd, size: overflow)
+    w.read_events()
+    monkeypatch.undo()
+    assert w.changes(w.last_change + watcher.WATCH_DEBOUNCE) is None
+    os.close(w.fd)
+
+
+# Applying changes
+
+def reorganize(library, tmp_path) -> set:
+    write_image(library / "a" / "one.png", 8, 6)  # Modified
+    write_image(library / "g" / "new.png", 2, 2)  # Added in a new folder
+    os.remove(library / "a" / "two.txt")
+    os.remove(library / "b" / "anim" / "0000.png")  # The folder entry's cover
+    shutil.move(str(library / "c"), str(library / "h"))
+    return {"a/one.png", "g", "a/two.txt", "b/anim/0000.png", "c", "h"}
+
+
+def test_update_files_matches_a_full_load(library, tmp_path):
+    database = open_library(library, tmp_path / "lib.appl")
+    database.build_text_index()
+    database.set_author(database.filepaths["c/d/three.txt"], "Kept")
+    report = database.update_files(reorganize(library, tmp_path))
+    assert report["moved"] == 1 and report["removed"] == ["a/two.txt"]
+
+    fresh = open_library(library, tmp_path / "fresh.appl")
+    assert entry_paths(database) == entry_paths(fresh)
+    assert database.filepaths["a/one.png"].resolution == (8, 6)
+    assert database.filepaths["h/d/three.txt"].author == "Kept"
+    assert os.path.exists(database.filepaths["b/anim"].cover_path)
+    fresh.build_text_index()
+    assert set(database.tokens) ^ set(fresh.tokens) == {"kept"}
+    database.close()
+    fresh.close()
+
+
+def test_update_files_from_polling_matches_a_full_load(library, tmp_path):
+    database = open_library(library, tmp_path / "lib.appl")
+    w = watcher.PollingWatcher(database.db_dir, database.ignored_files(), interval=0.05)
+    w.start()
+    try:
+        wait_started(w)
+        reorganize(library, tmp_path)
+        database.update_files(settle(w))
+    finally:
+        w.stop()
+    fresh = open_library(library, tmp_path / "fresh.appl")
+    assert entry_paths(database) == entry_paths(fresh)
+    database.close()
+    fresh.close()
+
+
+def test_update_files_ignores_the_database_files(library):
+    database = open_library(library, library / "lib.appl")
+    manifest = str(library / "lib.appl") + ".scan"
+    saved = os.stat(manifest).st_mtime_ns
+    database.set_author(database.entries[0], "Someone")
+    database.sync_journal()
+    report = database.update_files({"lib.appl", "lib.appl.journal", "lib.appl.scan", "a/one.png"})
+    assert (report["added"], report["changed"], report["removed"]) == (0, 0, [])
+    assert not any(path.startswith("lib.appl") for path in database.filepaths)
+    assert os.stat(manifest).st_mtime_ns == saved
+    database.close()
@@ -1,4 +1,10 @@
+import bisect
+import hashlib
 import os.path
+import re
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
 
 import cv2
 import numpy as np
@@ -21,64 +27,475 @@ LANGUAGE_CODES = {
 
 
 # Trie
-def list_tree(d: dict) -> list:
-    output = []
-    if "" in d:
-        output.append(d[""])
-    for e in d.keys():
-        if e == "":
-            continue
-        for a in list_tree(e):
-            output.append(a)
-    return output
+# A node per path segment. Every node counts the values below it, in
+# total and by kind (the extension, for file paths), so a folder can be
+# summarized without walking it.
+class TrieNode:
+    __slots__ = ("children", "value", "count", "kinds")
+
+    def __init__(self):
+        self.children = dict()
+        self.value = None
+        self.count = 0
+        self.kinds = dict()
+
+
+# Values in a subtree, depth first, produced as they're reached
+def list_tree(node: TrieNode):
+    stack = [node]
+    while len(stack) > 0:
+        node = stack.pop()
+        if node.value is not None:
+            yield node.value
+        stack.extend(reversed(node.children.values()))
+
+
+def trie_uncount(path: list, kind):
+    for n in path:
+        n.count -= 1
+        n.kinds[kind] -= 1
+        if n.kinds[kind] <= 0:
+            del n.kinds[kind]
 
 
 class Trie:
     def __init__(self):
-        self.root = dict()
-
-    def add(self, key: str, separator: str, value):
-        key_list = key.split(separator)
-        current_dict = self.root
-        for k in key_list:
-            if k not in current_dict:
-                current_dict[k] = dict()
-            current_dict = current_dict[k]
-        current_dict[""] = value
+        self.root = TrieNode()
+
+    def find(self, key: str, separator: str):
+        node = self.root
+        for k in key.split(separator):
+            if k == "":
+                continue
+            if k not in node.children:
+                return None
+            node = node.children[k]
+        return node
+
+    def add(self, key: str, separator: str, value, kind=None):
+        node = self.root
+        path = [node]
+        for k in key.split(separator):
+            if k == "":
+                continue
+            child = node.children.get(k)
+            if child is None:
+                child = node.children[k] = TrieNode()
+            node = child
+            path.append(node)
+        if node.value is not None:
+            trie_uncount(path, node.value[1])
+        node.value = (value, kind)
+        for n in path:
+            n.count += 1
+            n.kinds[kind] = n.kinds.get(kind, 0) + 1
 
     def get(self, key: str, separator: str):
-        key_list = key.split(separator)
-        current_dict = self.root
-        for k in key_list:
-            if k not in current_dict:
-                return None
-            current_dict = current_dict[k]
-        if "" in current_dict:
-            return current_dict[""]
-        else:
+        node = self.find(key, separator)
+        if node is None or node.value is None:
             return None
+        return node.value[0]
 
+    # Empty nodes are pruned on the way back up
     def remove(self, key: str, separator: str):
-        key_list = key.split(separator)
-        current_dict = self.root
-        for k in key_list:
-            if k not in current_dict:
+        node = self.root
+        path = [(None, node)]
+        for k in key.split(separator):
+            if k == "":
+                continue
+            if k not in node.children:
                 return
-            current_dict = current_dict[k]
-        if "" in current_dict:
-            current_dict.remove("")
+            node = node.children[k]
+            path.append((k, node))
+        if node.value is None:
+            return
+        trie_uncount([n for _, n in path], node.value[1])
+        node.value = None
+        for i in range(len(path) - 1, 0, -1):
+            k, n = path[i]
+            if n.count <= 0:
+                del path[i-1][1].children[k]
 
     def list_after(self, key: str, separator: str):
-        key_list = key.split(separator)
-        current_dict = self.root
-        for k in key_list:
-            if k not in current_dict:
-                return None
-            current_dict = current_dict[k]
-        return list_tree(current_dict)
+        node = self.find(key, separator)
+        if node is None:
+            return
+        for value, _ in list_tree(node):
+            yield value
 
     def list(self) -> list:
-        return list_tree(self.root)
+        return [value for value, _ in list_tree(self.root)]
+
+    def count(self, key: str, separator: str) -> int:
+        node = self.find(key, separator)
+        return 0 if node is None else node.count
+
+    def kinds(self, key: str, separator: str) -> dict:
+        node = self.find(key, separator)
+        return dict() if node is None else dict(node.kinds)
+
+    # (name, count, kinds) of the folders directly below, and the values
+    # directly inside
+    def children(self, key: str, separator: str):
+        node = self.find(key, separator)
+        folders = []
+        values = []
+        if node is None:
+            return folders, values
+        for name, child in node.children.items():
+            if len(child.children) > 0:
+                folders.append((name, child.count, dict(child.kinds)))
+            if child.value is not None:
+                values.append(child.value[0])
+        return folders, values
+
+
+# Bitmap
+# Ids are split into chunks of 65536. A chunk is a set of the low bits of
+# its ids while small, and becomes 1024 packed uint64 words once it passes
+# BITMAP_SPARSE_LIMIT, so intersections of large postings are vectorized.
+BITMAP_CHUNK_BITS = 16
+BITMAP_CHUNK_WORDS = (1 << BITMAP_CHUNK_BITS) // 64
+BITMAP_SPARSE_LIMIT = 4096
+
+
+def bitmap_dense_chunk(low_ids) -> np.ndarray:
+    words = np.zeros(BITMAP_CHUNK_WORDS, dtype=np.uint64)
+    ids = np.fromiter(low_ids, dtype=np.uint64, count=len(low_ids))
+    np.bitwise_or.at(words, ids >> np.uint64(6), np.left_shift(np.uint64(1), ids & np.uint64(63)))
+    return words
+
+
+def bitmap_dense_ids(words: np.ndarray) -> np.ndarray:
+    return np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder="little"))
+
+
+def bitmap_dense_contains(words: np.ndarray, low_ids: set) -> set:
+    ids = np.fromiter(low_ids, dtype=np.uint64, count=len(low_ids))
+    bits = np.right_shift(words[ids >> np.uint64(6)], ids & np.uint64(63)) & np.uint64(1)
+    return set(ids[bits.astype(bool)].tolist())
+
+
+def bitmap_chunk_and(a, b):
+    if isinstance(a, set) and isinstance(b, set):
+        return a & b
+    if isinstance(a, set):
+        return bitmap_dense_contains(b, a)
+    if isinstance(b, set):
+        return bitmap_dense_contains(a, b)
+    return a & b
+
+
+def bitmap_chunk_or(a, b):
+    if isinstance(a, set) and isinstance(b, set):
+        union = a | b
+        return union if len(union) <= BITMAP_SPARSE_LIMIT else bitmap_dense_chunk(union)
+    if isinstance(a, set):
+        a, b = b, a
+    if isinstance(b, set):
+        b = bitmap_dense_chunk(b)
+    return a | b
+
+
+def bitmap_chunk_difference(a, b):
+    if isinstance(a, set) and isinstance(b, set):
+        return a - b
+    if isinstance(a, set):
+        return a - bitmap_dense_contains(b, a)
+    if isinstance(b, set):
+        b = bitmap_dense_chunk(b)
+    return a & ~b
+
+
+def bitmap_chunk_empty(chunk) -> bool:
+    return len(chunk) <= 0 if isinstance(chunk, set) else not chunk.any()
+
+
+class Bitmap:
+    # Ids are grouped by chunk first, so a bulk load packs each dense chunk once
+    def __init__(self, ids=()):
+        self.chunks = dict()
+        mask = (1 << BITMAP_CHUNK_BITS) - 1
+        for i in ids:
+            key = i >> BITMAP_CHUNK_BITS
+            if key not in self.chunks:
+                self.chunks[key] = set()
+            self.chunks[key].add(i & mask)
+        for key, chunk in self.chunks.items():
+            if len(chunk) > BITMAP_SPARSE_LIMIT:
+                self.chunks[key] = bitmap_dense_chunk(chunk)
+
+    def add(self, i: int):
+        key, low = i >> BITMAP_CHUNK_BITS, i & ((1 << BITMAP_CHUNK_BITS) - 1)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            self.chunks[key] = {low}
+        elif isinstance(chunk, set):
+            chunk.add(low)
+            if len(chunk) > BITMAP_SPARSE_LIMIT:
+                self.chunks[key] = bitmap_dense_chunk(chunk)
+        else:
+            chunk[low >> 6] |= np.uint64(1 << (low & 63))
+
+    def remove(self, i: int):
+        key, low = i >> BITMAP_CHUNK_BITS, i & ((1 << BITMAP_CHUNK_BITS) - 1)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            return
+        if isinstance(chunk, set):
+            chunk.discard(low)
+            if len(chunk) <= 0:
+                self.chunks.pop(key)
+        else:
+            # Only a word that just emptied can leave the chunk empty
+            chunk[low >> 6] &= ~np.uint64(1 << (low & 63))
+            if chunk[low >> 6] == 0 and not chunk.any():
+                self.chunks.pop(key)
+
+    def __contains__(self, i: int) -> bool:
+        chunk = self.chunks.get(i >> BITMAP_CHUNK_BITS)
+        if chunk is None:
+            return False
+        low = i & ((1 << BITMAP_CHUNK_BITS) - 1)
+        if isinstance(chunk, set):
+            return low in chunk
+        return (int(chunk[low >> 6]) >> (low & 63)) & 1 == 1
+
+    def __len__(self) -> int:
+        total = 0
+        for chunk in self.chunks.values():
+            if isinstance(chunk, set):
+                total += len(chunk)
+            else:
+                total += int(np.unpackbits(chunk.view(np.uint8)).sum())
+        return total
+
+    def __bool__(self) -> bool:
+        return len(self.chunks) > 0
+
+    def __iter__(self):
+        for key in sorted(self.chunks.keys()):
+            base = key << BITMAP_CHUNK_BITS
+            chunk = self.chunks[key]
+            if isinstance(chunk, set):
+                for low in sorted(chunk):
+                    yield base + low
+            else:
+                for low in bitmap_dense_ids(chunk).tolist():
+                    yield base + low
+
+    def __and__(self, other):
+        output = Bitmap()
+        for key in self.chunks.keys() & other.chunks.keys():
+            chunk = bitmap_chunk_and(self.chunks[key], other.chunks[key])
+            if not bitmap_chunk_empty(chunk):
+                output.chunks[key] = chunk
+        return output
+
+    def __or__(self, other):
+        output = Bitmap()
+        for key in self.chunks.keys() | other.chunks.keys():
+            if key not in other.chunks:
+                chunk = self.chunks[key]
+            elif key not in self.chunks:
+                chunk = other.chunks[key]
+            else:
+                chunk = bitmap_chunk_or(self.chunks[key], other.chunks[key])
+            output.chunks[key] = chunk.copy()
+        return output
+
+    def __sub__(self, other):
+        output = Bitmap()
+        for key, chunk in self.chunks.items():
+            if key in other.chunks:
+                chunk = bitmap_chunk_difference(chunk, other.chunks[key])
+                if bitmap_chunk_empty(chunk):
+                    continue
+            output.chunks[key] = chunk.copy()
+        return output
+
+    def copy(self):
+        output = Bitmap()
+        output.chunks = {key: chunk.copy() for key, chunk in self.chunks.items()}
+        return output
+
+    def __repr__(self):
+        return "Bitmap(" + str(len(self)) + ")"
+
+
+# Many ids at once, packed a chunk at a time without visiting each id
+def bitmap_from_ids(ids) -> Bitmap:
+    output = Bitmap()
+    ids = np.sort(np.asarray(ids, dtype=np.int64))
+    if len(ids) <= 0:
+        return output
+    keys = ids >> BITMAP_CHUNK_BITS
+    lows = (ids & ((1 << BITMAP_CHUNK_BITS) - 1)).astype(np.uint64)
+    bounds = [0] + (np.flatnonzero(np.diff(keys)) + 1).tolist() + [len(ids)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        chunk = lows[start:end]
+        if end - start > BITMAP_SPARSE_LIMIT:
+            words = np.zeros(BITMAP_CHUNK_WORDS, dtype=np.uint64)
+            np.bitwise_or.at(words, chunk >> np.uint64(6), np.left_shift(np.uint64(1), chunk & np.uint64(63)))
+            output.chunks[int(keys[start])] = words
+        else:
+            output.chunks[int(keys[start])] = set(chunk.tolist())
+    return output
+
+
+# Sorted Index
+# Keeps (value, id) pairs in order, so a range of values is two bisections
+SORTED_INDEX_REMOVALS = 64
+
+
+class SortedIndex:
+    def __init__(self, pairs=()):
+        self.pairs = sorted(pairs)
+
+    def add(self, value, i: int):
+        bisect.insort(self.pairs, (value, i))
+
+    def remove(self, value, i: int):
+        position = bisect.bisect_left(self.pairs, (value, i))
+        if position < len(self.pairs) and self.pairs[position] == (value, i):
+            del self.pairs[position]
+
+    # Many removals filter the pairs in one pass rather than shifting them each time
+    def remove_many(self, pairs):
+        pairs = set(pairs)
+        if len(pairs) <= SORTED_INDEX_REMOVALS:
+            for value, i in pairs:
+                self.remove(value, i)
+        else:
+            self.pairs = [p for p in self.pairs if p not in pairs]
+
+    def bounds(self, low=None, high=None) -> (int, int):
+        start = 0 if low is None else bisect.bisect_left(self.pairs, (low, -1))
+        end = len(self.pairs) if high is None else bisect.bisect_right(self.pairs, (high, float("inf")))
+        return start, max(start, end)
+
+    def count(self, low=None, high=None) -> int:
+        start, end = self.bounds(low, high)
+        return end - start
+
+    def range(self, low=None, high=None) -> Bitmap:
+        start, end = self.bounds(low, high)
+        return Bitmap(pair[1] for pair in self.pairs[start:end])
+
+
+# LRU Cache
+# Everything cached belongs to one generation of the data it was computed
+# from. Asking with a newer generation drops the older results.
+# With a budget, the sizes given to put also have to fit within it, so a
+# few large results can't hold on to more memory than many small ones.
+class LRUCache:
+    def __init__(self, capacity: int, budget: int = None):
+        self.capacity = capacity
+        self.budget = budget
+        self.items = OrderedDict()
+        self.sizes = dict()
+        self.total = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.items.clear()
+        self.sizes.clear()
+        self.total = 0
+
+    def get(self, key, generation: int):
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+        if key not in self.items:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value, generation: int, size: int = 1):
+        if generation != self.generation:
+            return
+        if self.budget is not None and size > self.budget:
+            return
+        self.total += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.capacity or (self.budget is not None and self.total > self.budget):
+            old, _ = self.items.popitem(last=False)
+            self.total -= self.sizes.pop(old)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.items), "total": self.total,
+                "generation": self.generation}
+
+
+# Fuzzy Index
+# SymSpell style: every term is stored under each way of deleting up to
+# max_distance characters from its prefix. A misspelled word shares one of
+# those deletions with the terms it could be a typo of, so only those few
+# terms need their edit distance checked.
+def edit_distance(a: str, b: str, limit: int) -> int:
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i-1] == b[j-1] else 1
+            current[j] = min(previous[j] + 1, current[j-1] + 1, previous[j-1] + cost)
+            if (previous_previous is not None and i > 1 and j > 1
+                    and a[i-1] == b[j-2] and a[i-2] == b[j-1]):
+                current[j] = min(current[j], previous_previous[j-2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+class FuzzyIndex:
+    def __init__(self, max_distance: int = 2, prefix_length: int = 7):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.deletes = dict()
+
+    def variants(self, term: str) -> set:
+        output = {term[:self.prefix_length]}
+        edge = set(output)
+        for _ in range(self.max_distance):
+            edge = {v[:i] + v[i+1:] for v in edge for i in range(len(v))}
+            output.update(edge)
+        return output
+
+    def add(self, term: str):
+        for variant in self.variants(term):
+            if variant not in self.deletes:
+                self.deletes[variant] = set()
+            self.deletes[variant].add(term)
+
+    def remove(self, term: str):
+        for variant in self.variants(term):
+            if variant in self.deletes:
+                self.deletes[variant].discard(term)
+                if len(self.deletes[variant]) <= 0:
+                    self.deletes.pop(variant)
+
+    # Terms within max_distance of the word, with their distance
+    def lookup(self, word: str, max_distance: int) -> dict:
+        max_distance = min(max_distance, self.max_distance)
+        candidates = set()
+        for variant in self.variants(word):
+            candidates.update(self.deletes.get(variant, ()))
+        output = dict()
+        for term in candidates:
+            distance = edit_distance(word, term, max_distance)
+            if distance <= max_distance:
+                output[term] = distance
+        return output
 
 
 # Dictionary Add
@@ -88,16 +505,66 @@ def dictionary_list_add(d: dict, k, e):
     d[k].append(e)
 
 
-def dictionary_list_remove(d: dict, k, e):
+# Postings kept as dicts of value -> None: insertion ordered sets, so
+# removing a value doesn't scan a list
+def dictionary_set_add(d: dict, k, e):
+    if k not in d:
+        d[k] = dict()
+    d[k][e] = None
+
+
+def dictionary_set_remove(d: dict, k, e):
     if k not in d:
         return
-    if e not in d[k]:
-        return
-    d[k].remove(e)
+    d[k].pop(e, None)
     if len(d[k]) <= 0:
         d.pop(k)
 
 
+def dictionary_bitmap_add(d: dict, k, i: int):
+    if k not in d:
+        d[k] = Bitmap()
+    d[k].add(i)
+
+
+def dictionary_bitmap_remove(d: dict, k, i: int):
+    if k not in d:
+        return
+    d[k].remove(i)
+    if not d[k]:
+        d.pop(k)
+
+
+# Normalizing
+# Casefolded, with compatibility forms (full width letters, ligatures)
+# decomposed and accents stripped. Only the combining diacritical marks
+# are removed, so kana, Hebrew and Devanagari keep their marks.
+# Facet values repeat across many entries, so recent results are kept.
+ACCENTS = re.compile("[\u0300-\u036f]")
+
+
+@lru_cache(maxsize=65536)
+def normalize(text: str) -> str:
+    return ACCENTS.sub("", unicodedata.normalize("NFKD", text.casefold()))
+
+
+# Tokenizing
+TOKEN_SEPARATOR = re.compile(r"[\W_]+")
+
+
+def tokenize(text: str) -> list:
+    return split_tokens(normalize(text))
+
+
+# Tokens of text that's already normalized
+def split_tokens(text: str) -> list:
+    return [t for t in TOKEN_SEPARATOR.split(text) if t != ""]
+
+
+def trigrams(text: str) -> set:
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
 # Set Operations
 def powerset(s):
     n = len(s)
@@ -123,6 +590,14 @@ def hash_string(string: str) -> int:
         total += ord(c)
     return total
 
+
+def hash_file(path: str) -> str:
+    digest = hashlib.blake2b()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
 # Safe Open
 # def mkdir_p(path):
 #     try:
@@ -170,8 +645,7 @@ def cache_epub_cover(db_dir: str, cache: str, epub_path: str) -> str:
     nparr = np.frombuffer(cover_data, np.uint8)
     del cover_data
 
-    if not os.path.exists(db_dir + cache):
-        os.mkdir(db_dir + cache)
+    os.makedirs(db_dir + cache, exist_ok=True)  # Worker processes may race to create it
     epub_name = epub_path[epub_path.rfind("/")+1:epub_path.rfind(".")]
     image_path = db_dir + cache + "/" + epub_name + ".jpg"
     print("Cached Image Path " + image_path)
@@ -195,8 +669,7 @@ def cache_video_cover(db_dir: str, cache: str, vid_path: str) -> str:
     ret, frame = video.read()
     print(ret)
 
-    if not os.path.exists(db_dir + cache):
-        os.mkdir(db_dir + cache)
+    os.makedirs(db_dir + cache, exist_ok=True)
     epub_name = vid_path[vid_path.rfind("/")+1:vid_path.rfind(".")]
     image_path = db_dir + cache + "/" + epub_name + ".jpg"
     print("Cached Image Path " + image_path)
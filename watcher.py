@@ -0,0 +1,224 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+import scanner
+
+WATCH_DEBOUNCE = 1.0  # Seconds without changes before they are handed over
+WATCH_MAX_DELAY = 10.0  # Seconds after which changes are handed over anyway
+WATCH_POLL_INTERVAL = 5.0  # Seconds between scans when polling
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+#
+#
+# Watchers
+#
+# Watch the collection directory from a thread, collecting the paths of
+# the files and directories that changed, relative to the collection
+# directory. Changes made close together are coalesced and only handed
+# over once there have been none for WATCH_DEBOUNCE seconds, so a folder
+# being copied is picked up once it's done.
+#
+class Watcher:
+    def __init__(self, db_dir: str, ignored=lambda path: False):
+        self.db_dir = db_dir
+        self.base = scanner.base_dir(db_dir)
+        self.ignored = ignored
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.rescan = False  # Changes were lost, so everything must be scanned again
+        self.first_change = 0.0
+        self.last_change = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        pass
+
+    def changed(self, paths, rescan: bool = False):
+        now = time.monotonic()
+        with self.lock:
+            if len(self.pending) <= 0 and not self.rescan:
+                self.first_change = now
+            self.last_change = now
+            self.pending.update(p for p in paths if not self.ignored(self.base + p))
+            self.rescan = self.rescan or rescan
+
+    # The paths that changed once things have settled, None when everything
+    # must be scanned again, or an empty set
+    def changes(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if len(self.pending) <= 0 and not self.rescan:
+                return set()
+            if now - self.last_change < WATCH_DEBOUNCE and now - self.first_change < WATCH_MAX_DELAY:
+                return set()
+            paths = None if self.rescan else self.pending
+            self.pending = set()
+            self.rescan = False
+            return paths
+
+
+# Scans the collection directory every few seconds, comparing each file's
+# size, mtime and inode with the last scan. Nothing is scanned while the
+# directory is missing, as when a share isn't mounted.
+class PollingWatcher(Watcher):
+    def __init__(self, db_dir: str, ignored=lambda path: False, interval: float = WATCH_POLL_INTERVAL):
+        super().__init__(db_dir, ignored)
+        self.interval = interval
+        self.manifest = None
+
+    def scan(self, old: scanner.ScanManifest) -> scanner.ScanManifest:
+        new = scanner.ScanManifest(self.db_dir)
+        for _ in scanner.scan(old, new, self.ignored):
+            pass
+        return new
+
+    def run(self):
+        self.manifest = self.scan(scanner.ScanManifest(self.db_dir))
+        while not self.stopped.wait(self.interval):
+            if not os.path.isdir(self.base):
+                continue
+            manifest = self.scan(self.manifest)
+            old_files = self.manifest.files
+            paths = [f for f, state in manifest.files.items() if old_files.get(f) != state]
+            paths.extend(f for f in old_files if f not in manifest.files)
+            self.manifest = manifest
+            if len(paths) > 0:
+                self.changed(paths)
+
+
+# Linux inotify through libc, with a watch on every directory
+class InotifyWatcher(Watcher):
+    def __init__(self, db_dir: str, ignored=lambda path: False):
+        super().__init__(db_dir, ignored)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = dict()  # Watch descriptor -> directory, ending in "/"
+        self.add_watches("")
+
+    # Watches the directory and those below it
+    def add_watches(self, folder: str):
+        stack = [folder]
+        while len(stack) > 0:
+            folder = stack.pop()
+            path = self.base + folder
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                print("Not watched:", path, os.strerror(ctypes.get_errno()))
+                continue
+            self.folders[wd] = folder
+            try:
+                with os.scandir(path) as iterator:
+                    for entry in iterator:
+                        if entry.is_dir(follow_symlinks=False) and not self.ignored(entry.path + "/"):
+                            stack.append(folder + entry.name + "/")
+            except OSError:
+                pass
+
+    def remove_watches(self, folder: str):
+        for wd, watched in list(self.folders.items()):
+            if watched.startswith(folder):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.folders[wd]
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                ready, _, _ = select.select([self.fd], [], [], 0.25)
+                if len(ready) > 0:
+                    self.read_events()
+        finally:
+            os.close(self.fd)
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        paths = []
+        rescan = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                rescan = True
+                continue
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            folder = self.folders.get(wd)
+            if folder is None or mask & IN_DELETE_SELF:
+                continue
+            path = folder + name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    if not self.ignored(self.base + path + "/"):
+                        self.add_watches(path + "/")
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.remove_watches(path + "/")
+                else:
+                    continue
+            paths.append(path)
+        if len(paths) > 0 or rescan:
+            self.changed(paths, rescan)
+
+
+def inotify_available() -> bool:
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+        return hasattr(libc, "inotify_init1")
+    except OSError:
+        return False
+
+
+# Inotify where the system has it, polling otherwise
+def watch(db_dir: str, ignored=lambda path: False) -> Watcher:
+    watcher = None
+    if inotify_available():
+        try:
+            watcher = InotifyWatcher(db_dir, ignored)
+        except OSError as e:
+            print("Inotify unavailable, polling instead:", e)
+    if watcher is None:
+        watcher = PollingWatcher(db_dir, ignored)
+    watcher.start()
+    return watcher